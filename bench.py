@@ -0,0 +1,315 @@
+"""bench runs microbenchmarks for the performance-sensitive parts of the
+tuning pipeline. Each benchmark compares the current implementation
+against the reference (naive) computation it replaced."""
+
+import argparse
+import dataclasses
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import bootstrap
+import codec
+import codec_test
+import crossval
+import model
+
+
+def timed(fn, repeat=3):
+    """Return the best wall time (in seconds) of repeat calls to fn."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def synthetic_series(days, seed=0):
+    rng = np.random.RandomState(seed)
+    index = pd.date_range("2019-12-01", periods=days * 288, freq=model.Period, tz="UTC")
+    values = rng.exponential(size=len(index))
+    values[rng.uniform(size=len(index)) < 0.5] = 0.0
+    return pd.Series(values, index)
+
+
+def bench_convolve(days):
+    series = synthetic_series(days)
+    coeffs = model.expia1(model.Wtime, 1, 13, 40)
+    flipped = np.flip(coeffs, 0)
+
+    def reference():
+        series.rolling(window=model.Whoriz).apply(
+            lambda pids: np.dot(pids, flipped), raw=True
+        )
+
+    def current():
+        model.convolve(series.values, coeffs)
+
+    return timed(reference, repeat=1), timed(current)
+
+
+def bench_resample(days):
+    series = synthetic_series(days)
+    glucose = series[series > 0]
+    frame = codec.Request(
+        "US/Pacific",
+        [
+            codec.Timeseries("glucose", {}, glucose),
+            codec.Timeseries("insulin", {}, series),
+            codec.Timeseries("carb", {}, series[series > 3]),
+        ],
+    )
+    pad = pd.Series(0, pd.DatetimeIndex([series.index[0], series.index[-1]]))
+
+    def reference():
+        for col in frame.timeseries:
+            if col.ctype == "glucose":
+                col.series.resample(model.Period).first()
+            else:
+                col.series.combine_first(pad).resample(model.Period).sum()
+
+    def current():
+        model.resample_grid(frame)
+
+    return timed(reference), timed(current)
+
+
+def bench_expand(days):
+    rng = np.random.RandomState(0)
+    n = days * 288
+    index = 1576701990 + np.cumsum(rng.randint(0, 600, size=n))
+    values = rng.randint(0, 2000, size=n)
+    durations = rng.choice([0, 300, 1800, 3600], size=n)
+
+    def reference():
+        codec_test.reference_resample(
+            index.tolist(), values.tolist(), durations.tolist())
+
+    def current():
+        codec.resample(index, values, durations)
+
+    return timed(reference), timed(current)
+
+
+def bench_decode(days):
+    rng = np.random.RandomState(0)
+    n = days * 288
+    timelines = [
+        {
+            "type": "basal",
+            "index": [1576701990] + [300] * n,
+            "values": rng.randint(-100, 100, size=n + 1).tolist(),
+            "durations": rng.randint(0, 3600, size=n + 1).tolist(),
+        }
+        for _ in range(7)
+    ]
+    body = json.dumps({"timelines": timelines})
+
+    def reference():
+        for timeline in json.loads(body)["timelines"]:
+            for key in ["index", "values", "durations"]:
+                codec.undelta(timeline[key])
+
+    def current():
+        for timeline in codec.loads(body)["timelines"]:
+            for key in ["index", "values", "durations"]:
+                codec.undelta(timeline[key])
+
+    return timed(reference), timed(current)
+
+
+def synthetic_request(days, seed=0):
+    """A synthetic request with glucose, basal, bolus and carb timelines,
+    and schedules."""
+    rng = np.random.RandomState(seed)
+    n = days * 288
+    seconds = 1575158400 + 300 * np.arange(n)
+    glucose = 120 + np.cumsum(rng.normal(scale=2.0, size=n))
+    basal = 0.1 + 0.05 * rng.uniform(size=n)
+    bolus = np.where(rng.uniform(size=n) < 0.02, rng.uniform(1, 4, size=n), 0.0)
+    carbs = np.where(bolus > 0, bolus * 12, 0.0)
+    insulin_params = {"delay": 5, "peak": 65, "duration": 205}
+
+    def timeline(ctype, meta, values):
+        return codec.Timeseries.fromarrays(ctype, meta, seconds, values, "UTC")
+
+    def schedule(*entries):
+        index, values = zip(*entries)
+        return codec.Schedule(list(index), list(values))
+
+    return codec.Request(
+        timezone="UTC",
+        timeseries=[
+            timeline("glucose", {}, glucose),
+            timeline("basal", insulin_params, basal * 1000),
+            timeline("bolus", insulin_params, bolus * 1000),
+            timeline("carb", {"delay": 15, "duration": 120}, carbs),
+        ],
+        basal_insulin_parameters=insulin_params,
+        insulin_sensitivity_schedule=schedule((0, 140), (360, 100), (1080, 120)),
+        carb_ratio_schedule=schedule((0, 15), (420, 10)),
+        basal_rate_schedule=schedule((0, 0.8), (360, 1.0), (1200, 0.9)),
+    )
+
+
+def bench_fit(days):
+    request = synthetic_request(days)
+    hyper_params = dict(model.default_hyper_params)
+    stats = {}
+
+    def fit(gradient):
+        def run():
+            stats[gradient] = model.fit(
+                request, dict(hyper_params, gradient=gradient)).stats
+        return run
+
+    reference, current = timed(fit("2-point"), repeat=1), timed(fit("autograd"), repeat=1)
+    print(f"fit\tloss evaluations: reference {stats['2-point']['loss_evaluations']}"
+          f"\tcurrent {stats['autograd']['loss_evaluations']}")
+    return reference, current
+
+
+def bench_linprog(days):
+    request = synthetic_request(days)
+    request.tuning_limit = 0.3
+    hyper_params = dict(model.default_hyper_params)
+    losses = {}
+
+    def fit(optimizer):
+        def run():
+            losses[optimizer] = model.fit(
+                request, dict(hyper_params, optimizer=optimizer)).training_loss
+        return run
+
+    reference = timed(fit("scipy.minimize"), repeat=1)
+    current = timed(fit("linprog"), repeat=1)
+    print(f"linprog\ttraining loss: reference {losses['scipy.minimize']:.4f}"
+          f"\tcurrent {losses['linprog']:.4f}")
+    return reference, current
+
+
+def bench_loss(days):
+    rng = np.random.RandomState(0)
+    n = days * 288
+    hour = rng.randint(0, 24, size=n)
+    weights, deltas, carbs, insulin = rng.uniform(size=(4, n))
+    basals, isfs, carb_ratios = rng.uniform(0.5, 2.0, size=(3, 24))
+    moments = model.hourly_moments(hour, weights, deltas, carbs, insulin)
+
+    def reference():
+        preds = isfs[hour] * (carbs / carb_ratios[hour] - insulin + basals[hour])
+        np.mean(np.square(weights * (deltas - preds)))
+
+    def current():
+        model.squared_loss(moments, n, basals, isfs, carb_ratios)
+
+    return timed(reference), timed(current)
+
+
+def bench_tune(days):
+    request = synthetic_request(days)
+    stats = {}
+
+    def fit(tune_parameters):
+        def run():
+            request.tune_parameters = tune_parameters
+            stats[tune_parameters is None] = model.fit(request).stats
+        return run
+
+    reference = timed(fit(None), repeat=1)
+    current = timed(fit({"basal_rate_schedule"}), repeat=1)
+    print(f"tune\toptimizer time: reference {stats[True]['time']*1000:.2f}ms"
+          f"\tcurrent {stats[False]['time']*1000:.2f}ms")
+    return reference, current
+
+
+def bench_precision(days):
+    request = synthetic_request(days)
+    stats = {}
+
+    def fit(precision):
+        def run():
+            model.frame_cache.clear()
+            hyper_params = dict(model.default_hyper_params, precision=precision)
+            stats[precision] = model.fit(request, hyper_params).stats
+        return run
+
+    reference, current = timed(fit("float64"), repeat=1), timed(fit("float32"), repeat=1)
+    for key in ["frame_time", "time"]:
+        print(f"precision\t{key}: reference {stats['float64'][key]*1000:.2f}ms"
+              f"\tcurrent {stats['float32'][key]*1000:.2f}ms")
+    per_evaluation = {
+        precision: stats[precision]["time"] / stats[precision]["loss_evaluations"]
+        for precision in stats}
+    print(f"precision\tper evaluation: reference {per_evaluation['float64']*1000:.2f}ms"
+          f"\tcurrent {per_evaluation['float32']*1000:.2f}ms")
+    return reference, current
+
+
+def bench_bootstrap(days):
+    request = synthetic_request(days)
+    hyper_params = dict(model.default_hyper_params, bootstrap_replicates=8)
+
+    def run(processes):
+        return lambda: bootstrap.intervals(request, hyper_params, processes=processes)
+
+    reference, current = timed(run(1), repeat=1), timed(run(None), repeat=1)
+    print(f"bootstrap\tprocesses: {os.cpu_count()}")
+    return reference, current
+
+
+def bench_crossval(days):
+    request = synthetic_request(days)
+    folds = 5
+
+    def serial():
+        # Each fold recomputes the activity frame and is fitted in turn.
+        for fold in range(folds):
+            model.frame_cache.clear()
+            frame = model.make_frame(request, model.default_hyper_params)
+            test = crossval.fold_days(frame.index, folds) == fold
+            model.fit(request, sample_weights=pd.Series(np.where(test, 0.0, 1.0), frame.index))
+
+    def current():
+        crossval.cross_validate(request, folds=folds)
+
+    return timed(serial, repeat=1), timed(current, repeat=1)
+
+
+benchmarks = {
+    "convolve": bench_convolve,
+    "resample": bench_resample,
+    "expand": bench_expand,
+    "decode": bench_decode,
+    "fit": bench_fit,
+    "linprog": bench_linprog,
+    "loss": bench_loss,
+    "tune": bench_tune,
+    "precision": bench_precision,
+    "bootstrap": bench_bootstrap,
+    "crossval": bench_crossval,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", type=str, nargs="*", help="benchmarks to run")
+    parser.add_argument("--days", type=int, default=90, help="days of synthetic data")
+    args = parser.parse_args()
+
+    for name in args.names or benchmarks:
+        reference, current = benchmarks[name](args.days)
+        print(
+            f"{name}\treference {reference*1000:.2f}ms\t"
+            f"current {current*1000:.2f}ms\tspeedup {reference/current:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""bootstrap estimates confidence intervals for fitted schedules by
+refitting the model to block-bootstrap resamples of the request's days.
+
+A resample draws blocks of consecutive days, with replacement, until it
+covers as many days as the request. It is not materialized: each
+replicate fits the model with sample weights that count how many
+times each day was drawn (see model.fit). The activity frame is
+computed once and placed in shared memory (see sweep.SharedFrame),
+from which a pool of worker processes fit the replicates.
+
+Each replicate's schedules are evaluated at fixed slots of the day, and
+the intervals are per-slot percentiles over the replicates.
+"""
+
+import dataclasses
+import functools
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+
+import model
+import sweep
+
+
+def day_counts(ndays, block_days, rng):
+    """The number of times each of ndays days is drawn by a block
+    bootstrap with blocks of block_days days."""
+    block_days = max(1, min(block_days, ndays))
+    counts = np.zeros(ndays)
+    starts = rng.randint(0, ndays - block_days + 1, size=-(-ndays // block_days))
+    for start in starts:
+        counts[start:start + block_days] += 1
+    return counts
+
+
+def schedule_slots(schedule, slots):
+    """The values of schedule (an (index, values) pair, with index in
+    minutes) at each of slots (minutes past midnight)."""
+    index, values = schedule
+    i = np.searchsorted(index, slots, side="right") - 1
+    # Slots before the first entry are covered by the last one.
+    return np.asarray(values, dtype="float64")[i]
+
+
+# The request, hyper parameters, and shared activity frame of a
+# worker process.
+_request, _hyper_params, _activity = None, None, None
+
+
+def init_worker(request, hyper_params, frame):
+    global _request, _hyper_params, _activity
+    _request, _hyper_params = request, hyper_params
+    _activity = frame.activity()
+
+
+def fit_replicate(seed, slots):
+    """Fit the bootstrap replicate drawn with the given seed, returning
+    its schedules evaluated at slots, as a [len(schedule_names),
+    len(slots)] array, or None if the fit failed."""
+    frame, _ = _activity
+    days, uniques = pd.factorize(frame.index.normalize())
+    counts = day_counts(
+        len(uniques), _hyper_params["bootstrap_block_days"], np.random.RandomState(seed))
+    sample_weights = pd.Series(counts[days], index=frame.index)
+    try:
+        fitted = model.fit(
+            _request, _hyper_params, activity=_activity, sample_weights=sample_weights)
+    except Exception:
+        logging.exception(f"fitting bootstrap replicate {seed} failed")
+        return None
+    return np.stack([
+        schedule_slots(fitted.params[name], slots) for name in model.schedule_names])
+
+
+def intervals(request, hyper_params=model.default_hyper_params, activity=None,
+              slot_minutes=60, processes=None, seed=0):
+    """Compute confidence intervals for the schedules fitted to the
+    request, as configured by the bootstrap_* hyper parameters.
+
+    Returns a dict mapping each schedule name to a dict with the slots
+    ("index", in minutes) and the "lower" and "upper" bounds of the
+    interval at each slot (or None if no replicate completed), and the
+    number of replicates that were completed."""
+    hyper_params = {**model.default_hyper_params, **hyper_params, **request.hyper_params}
+    if activity is None:
+        activity = model.cached_activity_frame(request, hyper_params)
+    slots = np.arange(0, 24 * 60, slot_minutes)
+
+    replicates = []
+    time_limit = hyper_params["bootstrap_time_limit"]
+    deadline = time.monotonic() + time_limit if time_limit > 0 else None
+    shared = sweep.SharedFrame(*activity)
+    # As in sweep, workers don't need the request's timeseries.
+    bare = dataclasses.replace(request, timeseries=[], hyper_params={})
+    try:
+        with multiprocessing.Pool(
+                processes, initializer=init_worker,
+                initargs=(bare, hyper_params, shared)) as pool:
+            results = pool.imap_unordered(
+                functools.partial(fit_replicate, slots=slots),
+                [[seed, i] for i in range(hyper_params["bootstrap_replicates"])])
+            for _ in range(hyper_params["bootstrap_replicates"]):
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    result = results.next(timeout)
+                except multiprocessing.TimeoutError:
+                    # Leaving the pool terminates the remaining fits.
+                    break
+                if result is not None:
+                    replicates.append(result)
+    finally:
+        shared.close(unlink=True)
+
+    logging.info(
+        f"bootstrap: {len(replicates)} of {hyper_params['bootstrap_replicates']} replicates")
+    if not replicates:
+        return None, 0
+    confidence = hyper_params["bootstrap_confidence"]
+    lower, upper = np.percentile(
+        np.stack(replicates), [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    return {
+        name: {"index": slots.tolist(), "lower": lower[i].tolist(), "upper": upper[i].tolist()}
+        for i, name in enumerate(model.schedule_names)
+    }, len(replicates)
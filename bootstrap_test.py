@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+import bootstrap
+import model
+import model_test
+
+
+class BootstrapTest(unittest.TestCase):
+    def test_day_counts(self):
+        rng = np.random.RandomState(0)
+        for block_days in [1, 3, 20]:
+            counts = bootstrap.day_counts(10, block_days, rng)
+            self.assertEqual(len(counts), 10)
+            self.assertGreaterEqual(np.sum(counts), 10)
+            self.assertLess(np.sum(counts), 10 + block_days)
+        # A single block covers every day once.
+        np.testing.assert_array_equal(bootstrap.day_counts(10, 10, rng), np.ones(10))
+
+    def test_schedule_slots(self):
+        schedule = ([180, 600], [1.0, 2.0])
+        np.testing.assert_array_equal(
+            bootstrap.schedule_slots(schedule, [0, 180, 300, 600, 1380]),
+            [2.0, 1.0, 1.0, 2.0, 2.0])
+
+    def test_intervals(self):
+        request = model_test.make_days_request(4)
+        hyper_params = dict(model.default_hyper_params, bootstrap_replicates=4)
+        intervals, replicates = bootstrap.intervals(request, hyper_params, processes=2)
+        self.assertEqual(replicates, 4)
+        for name in model.schedule_names:
+            self.assertEqual(intervals[name]["index"], list(range(0, 24 * 60, 60)))
+            lower, upper = np.array(intervals[name]["lower"]), np.array(intervals[name]["upper"])
+            self.assertTrue(np.all(np.isfinite(lower)))
+            self.assertTrue(np.all(lower <= upper))
+
+    def test_time_limit(self):
+        request = model_test.make_days_request(4)
+        hyper_params = dict(
+            model.default_hyper_params, bootstrap_replicates=100, bootstrap_time_limit=1e-3)
+        intervals, replicates = bootstrap.intervals(request, hyper_params, processes=1)
+        self.assertLess(replicates, 100)
+        if replicates == 0:
+            self.assertIsNone(intervals)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,11 @@
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Any, Set
 import datetime
+import json
+import json.decoder
+import json.scanner
+import re
+import struct
 
 import numpy as np
 import pandas as pd
@@ -18,15 +23,80 @@ class MissingFieldError(Exception):
         super().__init__(f'missing field: "{field}"')
 
 
-@dataclass
+class FormatError(Exception):
+    def __init__(self, message):
+        super().__init__(f"invalid payload: {message}")
+
+
+def epoch_seconds(index):
+    """Return the Unix timestamps (in seconds) of a DatetimeIndex.
+    Timezone-naive indices are taken to be in UTC."""
+    return np.asarray(index.values, dtype="datetime64[ns]").astype("int64") // 10 ** 9
+
+
 class Timeseries:
     """Timeseries represents a single timeseries. A timeseries is a
-    time-indexed Pandas series with a type ("basal", "insulin", "carb")
-    and metadata (e.g., parameters for carb or insulin curves.)"""
-
-    ctype: str
-    meta: dict
-    series: pd.Series
+    time-indexed series of values with a type ("basal", "insulin",
+    "carb") and metadata (e.g., parameters for carb or insulin curves.)
+
+    Timeseries are stored as arrays of Unix timestamps (seconds) and
+    values; the equivalent Pandas series (indexed in the timeseries'
+    timezone) is materialized only when it is first accessed.
+
+    Entries with durations are expanded into 5-minute periods when
+    they are decoded (see resample); sources holds the timestamp of
+    the entry from which each period was expanded (by default, its
+    own timestamp)."""
+
+    __slots__ = ("ctype", "meta", "seconds", "values", "timezone", "sources", "_series")
+
+    def __init__(self, ctype, meta, series=None, seconds=None, values=None, timezone=None,
+                 sources=None):
+        self.ctype = ctype
+        self.meta = meta
+        self._series = series
+        if series is not None:
+            seconds = epoch_seconds(series.index)
+            values = series.values
+            timezone = series.index.tz
+        self.seconds = np.asarray(seconds, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.timezone = timezone
+        self.sources = self.seconds if sources is None else np.asarray(sources, dtype=np.int64)
+
+    def fromarrays(ctype, meta, seconds, values, timezone=None, sources=None):
+        values = np.asarray(values)
+        if values.dtype.kind != "f":
+            values = values.astype(np.float64)
+        return Timeseries(
+            ctype, meta, seconds=seconds, values=values, timezone=timezone, sources=sources)
+
+    @property
+    def series(self):
+        if self._series is None:
+            index = pd.to_datetime(self.seconds, unit="s", utc=True)
+            if self.timezone is not None:
+                index = index.tz_convert(self.timezone)
+            self._series = pd.Series(self.values, index)
+        return self._series
+
+    def window(self, start, end):
+        """The timeseries restricted to timestamps in [start, end]."""
+        return self.select((self.seconds >= start) & (self.seconds <= end))
+
+    def select(self, keep):
+        """The timeseries restricted to the entries where keep is true."""
+        if keep.all():
+            return self
+        return Timeseries.fromarrays(
+            self.ctype, self.meta, self.seconds[keep], self.values[keep], self.timezone,
+            self.sources[keep])
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def __repr__(self):
+        return f"Timeseries(ctype={self.ctype!r}, meta={self.meta!r}, len={len(self)})"
 
 
 @dataclass
@@ -44,7 +114,7 @@ class Schedule:
         return Schedule(index, values)
 
     def fromdict(d):
-        return Schedule(d["index"], d["values"])
+        return Schedule(tolist(d["index"]), tolist(d["values"]))
 
     def todict(self):
         return {
@@ -88,11 +158,30 @@ class Request:
     # all parameters are tuned.
     tune_parameters: Optional[Set[str]] = None
 
-    def fromdict(payload) -> "Request":
-        """Decode a JSON payload into a Request."""
+    def fromdict(payload, warmup=None) -> "Request":
+        """Decode a JSON payload into a Request (see decode)."""
+        return Request.decode(payload, timeline_columns, warmup)
+
+    def frombytes(buf, warmup=None) -> "Request":
+        """Decode a columnar payload (see dumps_columnar) into a
+        Request (see decode). Values and durations are decoded without
+        copying: they are views of buf."""
+        header, columns = read_columnar(buf)
+        return Request.decode(header, lambda i, timeline: columns[i], warmup)
+
+    def decode(payload, columns, warmup=None) -> "Request":
+        """Decode a Request from the payload, where columns(i, timeline)
+        returns the decoded index, values, and durations (or None) of the
+        i'th timeline.
+
+        If warmup is given, entries outside of the window selected by
+        the frame_limit hyper parameter, and the warmup(hyper_params)
+        seconds before it (see model.frame_warmup), are dropped."""
         if payload.get("version") is None:
             raise MissingFieldError("version")
-        if payload["version"] != 1:
+        # Version 2 additionally allows timelines to be run-length
+        # encoded.
+        if payload["version"] not in [1, 2]:
             raise VersionError(payload["version"])
 
         timezone = payload.get("timezone")
@@ -132,24 +221,52 @@ class Request:
 
         basal_insulin_parameters = payload.get("basal_insulin_parameters", {})
 
-        timeseries = []
-        for index, timeline in enumerate(raw_timelines):
-            series_type = timeline["type"]
+        decoded = []
+        for i, timeline in enumerate(raw_timelines):
+            if not isinstance(timeline, dict):
+                raise FormatError(f"series {i}: not an object")
+            series_type = timeline.get("type")
+            if series_type is None:
+                raise MissingFieldError("type")
             if not series_type in ["bolus", "basal", "insulin", "carb", "glucose"]:
-                raise Exception(
-                    f"series {index}: invalid series type {series_type}")
-            params = timeline.get("parameters", {})
-            index = undelta(timeline["index"])
-            values = undelta(timeline["values"])
-            if len(index) == 0:
-                continue
-            if "durations" in timeline:
-                durations = undelta(timeline["durations"])
+                raise FormatError(
+                    f"series {i}: invalid series type {series_type}")
+            check_runs(payload["version"], i, timeline)
+            index, values, durations = columns(i, timeline)
+            if len(index) > 0:
+                decoded.append((timeline, index, values, durations))
+
+        # Entries outside of the window selected by the frame_limit hyper
+        # parameter are dropped before they are expanded.
+        window = None
+        hyper_params = payload.get("hyper_params", {})
+        if decoded and warmup is not None and hyper_params.get("frame_limit"):
+            start, end = frame_window(
+                hyper_params["frame_limit"],
+                max(np.max(index) for _, index, _, _ in decoded))
+            window = start - warmup(hyper_params), end
+
+        timeseries = []
+        for timeline, index, values, durations in decoded:
+            if window is not None:
+                index, values = np.asarray(index), np.asarray(values)
+                last = index if durations is None else index + np.asarray(durations)
+                keep = (last >= window[0]) & (index <= window[1])
+                index, values = index[keep], values[keep]
+                if durations is not None:
+                    durations = np.asarray(durations)[keep]
+                if len(index) == 0:
+                    continue
+            sources = None
+            if durations is not None:
+                sources = np.repeat(index, resample_periods(durations))
                 index, values = resample(index, values, durations)
-            index = pd.to_datetime(index, unit="s", utc=True)
-            index = index.tz_convert(timezone)
-            series = pd.Series(values, index)
-            timeseries.append(Timeseries(series_type, params, series))
+            series = Timeseries.fromarrays(
+                timeline["type"], timeline.get("parameters", {}), index, values, timezone,
+                sources)
+            if window is not None:
+                series = series.window(*window)
+            timeseries.append(series)
 
         tune_parameters = payload.get("tune_parameters")
         if tune_parameters is not None:
@@ -171,35 +288,422 @@ class Request:
         )
 
 
+def frame_window(frame_limit, last):
+    """Return the [start, end] window (in Unix seconds) selected by
+    frame_limit: either a number of days of data ending at last (the
+    most recent timestamp), or a [start, end] pair of Unix timestamps."""
+    if isinstance(frame_limit, (list, tuple)):
+        start, end = frame_limit
+        return start, end
+    return last - frame_limit * 24 * 60 * 60, last
+
+
+def timeline_columns(i, timeline):
+    """Decode the (delta-encoded) columns of a JSON timeline."""
+    for key in ["index", "values"]:
+        if key not in timeline:
+            raise MissingFieldError(key)
+    index = undelta(timeline["index"])
+    values = undelta(timeline["values"])
+    durations = None
+    if "durations" in timeline:
+        durations = undelta(timeline["durations"])
+    return index, values, durations
+
+
 def undelta(list):
-    """Decode a delta-encoded series."""
-    array = np.array(list)
+    """Decode a delta-encoded series. Arrays (as decoded by loads) are
+    decoded in place."""
+    if isinstance(list, np.ndarray):
+        list = np.asarray(list)
+        return np.cumsum(list, out=list)
+    array = unrle(list)
     array = np.cumsum(array)
     return array
 
 
+def tolist(values):
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return values
+
+
+# The keys of arrays that TimelineDecoder decodes directly into NumPy
+# arrays, and the characters permitted in those arrays.
+_array_key = re.compile(r'"(?:index|values|durations)"\s*:\s*$')
+_numeric = re.compile(r"[0-9 \t\n\r,.eE+-]*")
+_number = re.compile(r"[ \t\n\r]*-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?[ \t\n\r]*")
+_run = rf"(?:{_number.pattern}|[ \t\n\r]*\[{_number.pattern},{_number.pattern}\][ \t\n\r]*)"
+_rle_array = re.compile(rf"(?:{_run}(?:,{_run})*)?[ \t\n\r]*\]")
+
+
+class TimelineDecoder(json.JSONDecoder):
+    """TimelineDecoder is a JSON decoder that parses numeric "index",
+    "values", and "durations" arrays directly into NumPy arrays,
+    without materializing them as lists of Python numbers. Integer
+    arrays are decoded as int64, others as float64. Run-length encoded
+    arrays (see rle) are expanded. Other arrays are decoded as usual."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.parse_array = self._parse_array
+        # The C scanner parses arrays itself, so we use the Python
+        # scanner, which defers to parse_array.
+        self.scan_once = json.scanner.py_make_scanner(self)
+
+    def _parse_array(self, s_and_end, scan_once):
+        s, end = s_and_end
+        if _array_key.search(s, max(0, end - 32), end - 1) is not None:
+            close = s.find("]", end)
+            if close >= 0 and _numeric.fullmatch(s, end, close) is not None:
+                try:
+                    array = parse_numbers(s[end:close])
+                except ValueError as e:
+                    raise json.JSONDecodeError(str(e), s, end)
+                if array is not None:
+                    return array, close + 1
+            match = _rle_array.match(s, end)
+            if match is not None:
+                try:
+                    array = parse_runs(s[end:match.end() - 1])
+                    return array.view(RunLengthDecoded), match.end()
+                except ValueError as e:
+                    raise json.JSONDecodeError(str(e), s, end)
+        return json.decoder.JSONArray(s_and_end, scan_once)
+
+
+# The classes of the characters permitted in numeric arrays, as a
+# bytes.translate table.
+_comma, _zero, _digit, _dot, _minus, _plus, _exp, _space = range(8)
+_nclass = 8
+_classes = np.full(256, 255, dtype=np.uint8)
+for _chars, _class in [(",", _comma), ("0", _zero), ("123456789", _digit), (".", _dot),
+                       ("-", _minus), ("+", _plus), ("eE", _exp), (" \t\n\r", _space)]:
+    _classes[np.frombuffer(_chars.encode("ascii"), dtype=np.uint8)] = _class
+_classes = _classes.tobytes()
+
+# Whether each pair of classes may be adjacent in a list of JSON
+# numbers, as a bytes.translate table from class * _nclass + class.
+# Only a single space after a comma is permitted, as json.dumps
+# separates numbers; other whitespace is removed first.
+_digits = [_zero, _digit]
+_follows = np.zeros((_nclass, _nclass), dtype=np.uint8)
+for _class in [_comma, _space]:
+    _follows[_class, [_minus] + _digits] = 1
+_follows[_comma, _space] = 1
+for _class in _digits:
+    _follows[_class, _digits + [_dot, _exp, _comma]] = 1
+for _class in [_dot, _minus, _plus]:
+    _follows[_class, _digits] = 1
+_follows[_exp, _digits + [_minus, _plus]] = 1
+_follows = np.concatenate([_follows.ravel(), np.zeros(256 - _nclass**2, dtype=np.uint8)]).tobytes()
+
+# The non-digit classes that may follow a pair of non-digit classes in
+# a number: an optional sign, fraction, and exponent (with an optional
+# sign), in that order.
+_then = np.zeros((_nclass, _nclass, _nclass), dtype=bool)
+_then[:, _comma, [_comma, _minus, _dot, _exp]] = True
+_then[:, _dot, [_comma, _exp]] = True
+_then[:, _exp, [_comma, _minus, _plus]] = True
+for _class in [_minus, _plus]:
+    _then[:, _class, [_comma, _dot, _exp]] = True
+    _then[_exp, _class, [_dot, _exp]] = False
+_then = _then.ravel()
+
+_bracket = np.array([_comma], dtype=np.uint8)
+
+
+def _adjacent(classes):
+    """Whether each pair of adjacent classes is permitted by _follows."""
+    return b"\0" not in (classes[:-1] * _nclass + classes[1:]).tobytes().translate(_follows)
+
+
+def well_formed(text):
+    """Whether text is a list of comma-separated JSON numbers. Once
+    whitespace is removed, the JSON number grammar constrains only
+    adjacent characters, and the order of the non-digit characters of
+    each number, so it is checked by table lookups."""
+    classes = np.frombuffer(
+        text.encode("ascii", "replace").translate(_classes), dtype=np.uint8)
+    if classes.max() > _space:
+        return False
+    classes = np.concatenate([_bracket, classes, _bracket])
+    if not _adjacent(classes):
+        if classes.max() < _space:
+            return False
+        # Whitespace may only separate numbers from commas.
+        kept = np.flatnonzero(classes != _space)
+        classes = classes[kept]
+        spaced = np.flatnonzero(np.diff(kept) > 1)
+        if np.any((classes[spaced] != _comma) & (classes[spaced + 1] != _comma)):
+            return False
+        if not _adjacent(classes):
+            return False
+
+    other = np.frombuffer(
+        classes.tobytes().translate(None, bytes([_zero, _digit, _space])), dtype=np.uint8)
+    other = other.astype(np.intp)
+    if not np.all(_then[(other[:-2] * _nclass + other[1:-1]) * _nclass + other[2:]]):
+        return False
+
+    # No leading zeros: integer parts start after a comma (and perhaps
+    # a space), or after a sign that follows one.
+    zeros = np.flatnonzero(
+        (classes[1:-1] == _zero) & ((classes[2:] == _zero) | (classes[2:] == _digit))) + 1
+    start = (classes[zeros - 1] == _comma) | (classes[zeros - 1] == _space)
+    signed = (classes[zeros - 1] == _minus) & (
+        (classes[zeros - 2] == _comma) | (classes[zeros - 2] == _space))
+    return not np.any(start | signed)
+
+
+def parse_numbers(text):
+    """Parse comma-separated numbers into an array, returning None if
+    the text is malformed. Raises ValueError if an integer is outside
+    the int64 range."""
+    if text.strip() == "":
+        return np.zeros(0, dtype=np.int64)
+    if not well_formed(text):
+        return None
+    if any(c in text for c in ".eE"):
+        dtype = np.float64
+    else:
+        dtype = np.int64
+    array = np.fromstring(text, dtype=dtype, sep=",")
+    # np.fromstring saturates integers outside the int64 range.
+    if dtype is np.int64:
+        bounds = np.iinfo(np.int64)
+        if np.any((array == bounds.min) | (array == bounds.max)):
+            if any(not bounds.min <= int(number) <= bounds.max for number in text.split(",")):
+                raise ValueError("integer out of range")
+    return array
+
+
+def parse_runs(text):
+    """Parse (well-formed) comma-separated numbers and [value, count]
+    runs into an array with the runs expanded. Raises ValueError if a
+    count is not a non-negative integer."""
+    flat = parse_numbers(text.replace("[", " ").replace("]", " "))
+    # A run starts at the number following as many commas as
+    # precede its opening bracket.
+    chars = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    commas = np.cumsum(chars == ord(","))
+    starts = commas[chars == ord("[")]
+    counts = np.ones(len(flat), dtype=np.int64)
+    counts[starts] = run_counts(flat[starts + 1])
+    keep = np.ones(len(flat), dtype=bool)
+    keep[starts + 1] = False
+    return np.repeat(flat[keep], counts[keep])
+
+
+class RunLengthDecoded(np.ndarray):
+    """The type of the arrays that TimelineDecoder expanded from
+    run-length encoded arrays, so that they can be told apart from
+    plain ones (see run_length_encoded)."""
+
+
+def run_length_encoded(values):
+    """Report whether a timeline array, as decoded by json.loads or
+    loads, was run-length encoded."""
+    if isinstance(values, np.ndarray):
+        return isinstance(values, RunLengthDecoded)
+    return isinstance(values, list) and any(
+        isinstance(value, (list, tuple)) for value in values)
+
+
+def check_runs(version, i, timeline):
+    """Raise FormatError if the i'th timeline is run-length encoded
+    but the payload version does not allow it."""
+    if version < 2 and any(
+            run_length_encoded(timeline.get(key, []))
+            for key in ["index", "values", "durations"]):
+        raise FormatError(f"series {i}: run-length encoding requires version 2")
+
+
+def rle(array):
+    """Run-length encode an array: each run of n > 1 equal values is
+    replaced by the pair [value, n]."""
+    array = np.asarray(array)
+    if len(array) == 0:
+        return []
+    starts = np.flatnonzero(np.concatenate([[True], array[1:] != array[:-1]]))
+    counts = np.diff(np.append(starts, len(array)))
+    return [
+        value if count == 1 else [value, count]
+        for value, count in zip(array[starts].tolist(), counts.tolist())
+    ]
+
+
+def run_counts(counts):
+    """Return the counts of runs as an int64 array, raising ValueError
+    unless they are non-negative integers."""
+    counts = np.asarray(counts)
+    if counts.dtype.kind not in "iuf" or not np.all(
+            np.isfinite(counts) & (counts >= 0) & (counts == np.floor(counts))):
+        raise ValueError("run counts must be non-negative integers")
+    return counts.astype(np.int64)
+
+
+def unrle(values):
+    """Expand a (possibly) run-length encoded list into an array.
+    Raises ValueError if a count is not a non-negative integer."""
+    if isinstance(values, np.ndarray):
+        return values
+    runs = [isinstance(value, (list, tuple)) for value in values]
+    if not any(runs):
+        return np.array(values)
+    counts = run_counts([value[1] if run else 1 for value, run in zip(values, runs)])
+    values = np.array([value[0] if run else value for value, run in zip(values, runs)])
+    return np.repeat(values, counts)
+
+
+def loads(s):
+    """Decode a JSON request body, parsing timeline arrays directly into
+    NumPy arrays. Note that Request.fromdict decodes these arrays in
+    place, so a payload returned by loads may only be decoded once."""
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode("utf-8")
+    return json.loads(s, cls=TimelineDecoder)
+
+
+def load(file):
+    return loads(file.read())
+
+
+def resample_periods(durations):
+    """The number of 5-minute periods into which resample expands each
+    entry with the given durations (in seconds)."""
+    durations = np.asarray(durations)
+    # Special case for instanteneous events: we spread it across
+    # the full period. (That's the limit of the model resolution
+    # anyway.)
+    durations = np.where(durations == 0, 300, durations)
+    return np.maximum((durations + 300 - 1) // 300, 0).astype(np.int64)
+
+
 def resample(index, values, durations):
     """Resample the series provided the given durations (in seconds).
     The data are always resampled to 5 minute increments. Note that
     the returned index may have duplicate entries and also be out of
     order. However, this should present no concern as these series are
     immediately resampled."""
-    index_out = []
-    values_out = []
-    for timestamp, value, duration in zip(index, values, durations):
-        # Special case for instanteneous events: we spread it across
-        # the full period. (That's the limit of the model resolution
-        # anyway.)
-        if duration == 0:
-            duration = 300
-        nperiod = (duration + 300 - 1) // 300
-        for period in range(nperiod):
-            index_out.append(timestamp + period * 300)
-            values_out.append(value / nperiod)
-
+    index = np.asarray(index)
+    values = np.asarray(values)
+    nperiod = resample_periods(durations)
+
+    # Each entry expands into nperiod consecutive periods; offsets
+    # counts the periods within each entry's expansion.
+    starts = np.cumsum(nperiod) - nperiod
+    offsets = np.arange(np.sum(nperiod)) - np.repeat(starts, nperiod)
+    index_out = np.repeat(index, nperiod) + offsets * 300
+    values_out = np.repeat(values / np.maximum(nperiod, 1), nperiod)
     return index_out, values_out
 
 
+# The columnar encoding is an alternative to the JSON encoding of
+# requests. A columnar payload begins with a fixed header:
+#
+#   magic           4 bytes, "TUNE"
+#   format version  uint32
+#   header length   uint32
+#
+# followed by a UTF-8 JSON header of the given length. The header is
+# a JSON request (see README.md), except that each timeline specifies
+# its "length" and whether it has "durations" in place of its index,
+# values and durations. The header is followed by each timeline's
+# columns, in order:
+#
+#   index      int64[length], delta-encoded Unix timestamps
+#   values     float32[length]
+#   durations  int32[length] (if present), in seconds
+#
+# All numbers are little-endian, and each column (as well as the JSON
+# header) is padded to a multiple of 8 bytes.
+columnar_content_type = "application/x-tune-columnar"
+columnar_magic = b"TUNE"
+columnar_version = 1
+
+
+def _padded(n):
+    return (n + 7) // 8 * 8
+
+
+def read_columnar(buf):
+    """Read a columnar payload, returning its JSON header and a list
+    of (index, values, durations) columns for each timeline."""
+    buf = memoryview(buf)
+    if bytes(buf[:4]) != columnar_magic:
+        raise FormatError("bad columnar magic")
+    version, header_length = struct.unpack_from("<II", buf, 4)
+    if version != columnar_version:
+        raise VersionError(version)
+    offset = 12
+    header = json.loads(bytes(buf[offset:offset + header_length]))
+    offset = _padded(offset + header_length)
+
+    def column(dtype, length):
+        nonlocal offset
+        nbytes = np.dtype(dtype).itemsize * length
+        if offset + nbytes > len(buf):
+            raise FormatError("truncated columnar column")
+        array = np.frombuffer(buf, dtype=dtype, count=length, offset=offset)
+        offset = _padded(offset + nbytes)
+        return array
+
+    columns = []
+    for timeline in header.get("timelines", []):
+        length = timeline["length"]
+        index = np.cumsum(column("<i8", length))
+        values = column("<f4", length)
+        durations = None
+        if timeline.get("durations", False):
+            durations = column("<i4", length)
+        columns.append((index, values, durations))
+    return header, columns
+
+
+def dumps_columnar(payload):
+    """Encode a JSON request payload (with delta-encoded timelines) in
+    the columnar encoding."""
+    header = dict(payload)
+    header["timelines"] = []
+    columns = []
+    for i, timeline in enumerate(payload["timelines"]):
+        check_runs(payload.get("version", 1), i, timeline)
+        index = unrle(timeline["index"]).astype("<i8")
+        values = undelta(unrle(timeline["values"]).astype("float64"))
+        columns += [index, values.astype("<f4")]
+        entry = {
+            "type": timeline["type"],
+            "parameters": timeline.get("parameters", {}),
+            "length": len(index),
+            "durations": "durations" in timeline,
+        }
+        if entry["durations"]:
+            durations = undelta(unrle(timeline["durations"]).astype("int64"))
+            columns.append(durations.astype("<i4"))
+        header["timelines"].append(entry)
+
+    encoded_header = json.dumps(header).encode("utf-8")
+    chunks = [
+        columnar_magic,
+        struct.pack("<II", columnar_version, len(encoded_header)),
+    ]
+    offset = 12
+    for chunk in [encoded_header] + [column.tobytes() for column in columns]:
+        padding = _padded(offset + len(chunk)) - offset - len(chunk)
+        chunks += [chunk, bytes(padding)]
+        offset += len(chunk) + padding
+    return b"".join(chunks)
+
+
+def decode_request(body, warmup=None):
+    """Decode a request body in either the JSON or the columnar encoding,
+    as determined by the columnar magic (see Request.decode)."""
+    if bytes(body[:4]) == columnar_magic:
+        return Request.frombytes(body, warmup)
+    return Request.fromdict(loads(body), warmup)
+
+
 @dataclass
 class Response:
     version: int
@@ -211,6 +715,15 @@ class Response:
 
     training_loss: Optional[float]
 
+    # The schedules that were fitted. Others are returned as provided
+    # in the request.
+    tuned_parameters: Optional[List[str]] = None
+
+    # Bootstrap confidence intervals for the schedules, if requested:
+    # for each schedule, the slots ("index") and the "lower" and
+    # "upper" bounds at each slot.
+    confidence_intervals: Optional[Dict[str, Dict[str, list]]] = None
+
     def todict(self):
         d = {
             "version": self.version,
@@ -221,6 +734,10 @@ class Response:
         }
         if self.training_loss is not None:
             d["training_loss"] = self.training_loss
+        if self.tuned_parameters is not None:
+            d["tuned_parameters"] = self.tuned_parameters
+        if self.confidence_intervals is not None:
+            d["confidence_intervals"] = self.confidence_intervals
         return d
 
     def fromdict(d):
@@ -233,4 +750,6 @@ class Response:
             carb_ratio_schedule=Schedule.fromdict(d["carb_ratio_schedule"]),
             basal_rate_schedule=Schedule.fromdict(d["basal_rate_schedule"]),
             training_loss=d.get("training_loss"),
+            tuned_parameters=d.get("tuned_parameters"),
+            confidence_intervals=d.get("confidence_intervals"),
         )
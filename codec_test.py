@@ -1,3 +1,5 @@
+import json
+import time
 import unittest
 
 import numpy as np
@@ -28,7 +30,11 @@ class TestCodec(unittest.TestCase):
         series = frame.timeseries[0]
         self.assertEqual(series.ctype, "glucose")
         self.assertEqual(series.meta, {"meta": "yes"})
+        np.testing.assert_array_equal(
+            series.seconds, [1576701990, 1576702290, 1576702590, 1576702890])
+        np.testing.assert_array_equal(series.values, [100, 110, 47.5, 47.5])
         np.testing.assert_array_equal(series.series.values, [100, 110, 47.5, 47.5])
+        self.assertIs(series.series, series.series)
         self.assertTrue(
             (
                 series.series.index
@@ -45,8 +51,227 @@ class TestCodec(unittest.TestCase):
             ).all()
         )
 
+    def test_timeseries(self):
+        index = pd.DatetimeIndex(
+            ["2019-12-18 20:46:30+00:00", "2019-12-18 20:51:30+00:00"])
+        series = pd.Series([1.0, 2.0], index.tz_convert("US/Pacific"))
+        timeseries = codec.Timeseries("carb", {}, series)
+        self.assertIs(timeseries.series, series)
+        np.testing.assert_array_equal(timeseries.seconds, [1576701990, 1576702290])
+
+        timeseries = codec.Timeseries.fromarrays(
+            "carb", {}, timeseries.seconds, [1, 2], "US/Pacific")
+        self.assertEqual(timeseries.values.dtype, np.float64)
+        pd.testing.assert_series_equal(timeseries.series, series)
+
+    def test_loads(self):
+        payload = json.dumps(
+            {
+                "version": 1,
+                "timezone": "UTC",
+                "timelines": [
+                    {
+                        "type": "basal",
+                        "parameters": {"delay": 5, "peak": 65, "duration": 205},
+                        "index": [1576701990, 300, 300],
+                        "values": [1.5, 0.5, -1],
+                        "durations": [0, 0, 600],
+                    },
+                    {"type": "carb", "index": [], "values": []},
+                ],
+                "basal_rate_schedule": {"index": [0, 360], "values": [0.2, 0.3]},
+            }
+        )
+        decoded = codec.loads(payload)
+        timeline = decoded["timelines"][0]
+        self.assertEqual(timeline["index"].dtype, np.int64)
+        self.assertEqual(timeline["values"].dtype, np.float64)
+        self.assertEqual(
+            timeline["parameters"], {"delay": 5, "peak": 65, "duration": 205})
+
+        expected = codec.Request.fromdict(json.loads(payload))
+        actual = codec.Request.fromdict(decoded)
+        self.assertEqual(actual.basal_rate_schedule, expected.basal_rate_schedule)
+        self.assertEqual(len(actual.timeseries), 1)
+        pd.testing.assert_series_equal(
+            actual.timeseries[0].series, expected.timeseries[0].series)
+
+        with self.assertRaises(json.JSONDecodeError):
+            codec.loads('{"index": [1 2]}')
+
+    def test_parse_numbers(self):
+        np.testing.assert_array_equal(
+            codec.parse_numbers(" -1.5e3, 0 ,2E-01,10"), [-1500.0, 0.0, 0.2, 10.0])
+        np.testing.assert_array_equal(
+            codec.parse_numbers("-9223372036854775808,9223372036854775807"),
+            [np.iinfo(np.int64).min, np.iinfo(np.int64).max])
+        for text in ["1.", ".5", "1,,2", "1,", "+1", "01", "-", "1e", "1e5.0", "1.2.3", "1e2e3"]:
+            self.assertIsNone(codec.parse_numbers(text), text)
+        # Out of range integers would otherwise saturate.
+        with self.assertRaises(ValueError):
+            codec.parse_numbers("1,9223372036854775808")
+        for text in ['{"index": [1., 2]}', '{"index": [99999999999999999999]}']:
+            with self.assertRaises(json.JSONDecodeError):
+                codec.loads(text)
+
+    def test_columnar(self):
+        payload = {
+            "version": 1,
+            "timezone": "US/Pacific",
+            "timelines": [
+                {
+                    "type": "basal",
+                    "parameters": {"delay": 5, "peak": 65, "duration": 205},
+                    "index": [1576701990, 300, 300],
+                    "values": [1.5, 0.5, -1],
+                    "durations": [0, 0, 600],
+                },
+                {"type": "glucose", "index": [1576701990, 301], "values": [100, 2]},
+            ],
+            "tuning_limit": 0.35,
+        }
+        body = codec.dumps_columnar(payload)
+        self.assertEqual(len(body) % 8, 0)
+
+        expected = codec.Request.fromdict(json.loads(json.dumps(payload)))
+        actual = codec.decode_request(body)
+        self.assertEqual(actual.tuning_limit, 0.35)
+        self.assertEqual(len(actual.timeseries), 2)
+        for want, got in zip(expected.timeseries, actual.timeseries):
+            self.assertEqual(want.ctype, got.ctype)
+            self.assertEqual(want.meta, got.meta)
+            pd.testing.assert_series_equal(
+                want.series, got.series, check_dtype=False)
+
+        with self.assertRaises(codec.FormatError):
+            codec.Request.frombytes(body[:-8])
+
+    def test_rle(self):
+        array = np.array([300, 300, 300, 1, 2, 2, 3])
+        self.assertEqual(codec.rle(array), [[300, 3], 1, [2, 2], 3])
+        self.assertEqual(codec.rle([]), [])
+        np.testing.assert_array_equal(codec.unrle(codec.rle(array)), array)
+
+        def payload(version, encode):
+            return {
+                "version": version,
+                "timezone": "UTC",
+                "timelines": [
+                    {
+                        "type": "basal",
+                        "index": encode([1576701990, 300, 300, 300]),
+                        "values": encode([0.5, 0, 0, 0.25]),
+                        "durations": encode([300, 0, 0, 0]),
+                    }
+                ],
+            }
+
+        expected = codec.Request.fromdict(payload(1, list)).timeseries[0].series
+        for decode in [json.loads, codec.loads]:
+            body = json.dumps(payload(2, codec.rle))
+            self.assertIn("[300, 3]", body)
+            actual = codec.Request.fromdict(decode(body)).timeseries[0].series
+            pd.testing.assert_series_equal(actual, expected)
+
+        actual = codec.Request.frombytes(codec.dumps_columnar(payload(2, codec.rle)))
+        pd.testing.assert_series_equal(
+            actual.timeseries[0].series, expected, check_dtype=False)
+
+        # Only version 2 allows runs.
+        body = json.dumps(payload(1, codec.rle))
+        for decode in [json.loads, codec.loads]:
+            with self.assertRaises(codec.FormatError):
+                codec.Request.fromdict(decode(body))
+        with self.assertRaises(codec.FormatError):
+            codec.dumps_columnar(payload(1, codec.rle))
+
+        # Counts must be non-negative integers.
+        for runs in ["[[1, -1]]", "[[1, 2.7]]", "[2, [1, 1e400]]"]:
+            with self.assertRaises(ValueError):
+                codec.undelta(json.loads(runs))
+            with self.assertRaises(json.JSONDecodeError):
+                codec.loads(f'{{"index": {runs}}}')
+        np.testing.assert_array_equal(codec.unrle([[1, 2.0], [3, 0]]), [1, 1])
+
+    def test_frame_limit(self):
+        day = 24 * 60 * 60
+        start = 1576701900
+        payload = {
+            "version": 1,
+            "timezone": "UTC",
+            "timelines": [
+                {
+                    # A basal delivered for a full day, from four days
+                    # before the most recent data.
+                    "type": "basal",
+                    "index": [start, 3 * day],
+                    "values": [288, -288],
+                    "durations": [day, 300 - day],
+                },
+                {
+                    "type": "glucose",
+                    "index": [start] + [day] * 4,
+                    "values": [100] * 5,
+                },
+            ],
+            "hyper_params": {"frame_limit": 2.75},
+        }
+        warmup = 7 * 60 * 60
+        request = codec.Request.fromdict(payload, lambda hyper_params: warmup)
+        cutoff = start + 4 * day - 2.75 * day - warmup
+        for col in request.timeseries:
+            self.assertTrue(np.all(col.seconds >= cutoff))
+        basal, glucose = request.timeseries
+        # The tail of the first basal entry overlaps the window.
+        self.assertEqual(np.sum(basal.values), (start + day - cutoff) // 300)
+        np.testing.assert_array_equal(glucose.seconds, start + np.arange(1, 5) * day)
+
+        payload["hyper_params"]["frame_limit"] = [start + 3 * day, start + 3 * day]
+        basal, glucose = codec.Request.fromdict(payload, lambda hyper_params: warmup).timeseries
+        np.testing.assert_array_equal(glucose.seconds, [start + 3 * day])
+
+        # Without a warm-up, nothing is dropped.
+        basal, glucose = codec.Request.fromdict(payload).timeseries
+        self.assertEqual(len(glucose), 5)
+
     # print(column.series().asfreq('5min'))
 
 
+def reference_resample(index, values, durations):
+    """The original (loop-based) implementation of codec.resample."""
+    index_out = []
+    values_out = []
+    for timestamp, value, duration in zip(index, values, durations):
+        if duration == 0:
+            duration = 300
+        nperiod = (duration + 300 - 1) // 300
+        for period in range(nperiod):
+            index_out.append(timestamp + period * 300)
+            values_out.append(value / nperiod)
+    return index_out, values_out
+
+
+class TestResample(unittest.TestCase):
+    def test_resample(self):
+        rng = np.random.RandomState(0)
+        n = 100000
+        index = 1576701990 + np.cumsum(rng.randint(0, 600, size=n))
+        values = rng.randint(0, 2000, size=n)
+        durations = rng.choice([0, 1, 299, 300, 301, 1800, 3600], size=n)
+
+        start = time.perf_counter()
+        expected_index, expected_values = reference_resample(
+            index.tolist(), values.tolist(), durations.tolist())
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual_index, actual_values = codec.resample(index, values, durations)
+        current_time = time.perf_counter() - start
+
+        np.testing.assert_array_equal(actual_index, expected_index)
+        np.testing.assert_array_equal(actual_values, expected_values)
+        self.assertLess(current_time, reference_time)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+"""crossval estimates how well the model generalizes, by time-series
+cross-validation.
+
+The training frame is split into folds of contiguous days. Each fold
+is held out in turn: the model is fitted to the remaining days and
+evaluated, by its pinball loss, on the held-out ones. Since the
+training frame's deltas and rolling means look back in time, the rows
+just after a held-out block (within rolling_window + delta_window
+periods) are left out of training too.
+
+As in sweep, insulin and carb activity is computed once and shared
+with a pool of worker processes, which fit the folds concurrently.
+Folds are not materialized: each is fitted with sample weights (see
+model.fit) that exclude the held-out rows.
+
+For example:
+
+    $ python crossval.py request.json --folds 5
+    $ python crossval.py request.json --param rolling_window=1,4,8 \\
+        --param maxdelta=5,10
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import multiprocessing
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+import codec
+import model
+import sweep
+
+
+@dataclasses.dataclass
+class Fold:
+    # The first and last (held-out) day of the fold.
+    start: str
+    end: str
+
+    # The mean out-of-sample pinball loss over the fold's rows.
+    loss: float
+
+    # The training loss of the model fitted without the fold.
+    training_loss: float
+
+    rows: int
+
+
+@dataclasses.dataclass
+class CrossValidation:
+    hyper_params: Dict[str, Any]
+
+    # The mean out-of-sample pinball loss over all held-out rows (NaN
+    # if there are none).
+    loss: float
+
+    folds: List[Fold]
+
+    # The mean out-of-sample pinball loss over the held-out rows in
+    # each hour of the day (NaN for hours without any).
+    hourly_loss: np.ndarray
+
+
+def fold_days(index, folds):
+    """Assign each time in index to one of folds blocks of contiguous
+    days."""
+    days, uniques = pd.factorize(index.normalize())
+    blocks = np.array_split(np.arange(len(uniques)), max(1, min(folds, len(uniques))))
+    fold = np.empty(len(uniques), dtype=int)
+    for i, block in enumerate(blocks):
+        fold[block] = i
+    return fold[days]
+
+
+def fit_fold(task):
+    """Fit the configuration with the given fold held out, in a worker
+    process of sweep's (see sweep.init_worker). Returns the fold's
+    statistics, and the sums and counts of the out-of-sample loss in
+    each hour of the day; or None if the fold is empty."""
+    i, hyper_params, fold, folds = task
+    request, activity = sweep.worker_frame(hyper_params)
+    frame = model.make_frame(request, hyper_params, activity=activity)
+    test = fold_days(frame.index, folds) == fold
+    if not np.any(test):
+        return None
+    gap = hyper_params["rolling_window"] + hyper_params["delta_window"]
+    excluded = pd.Series(test.astype(float)).rolling(gap + 1, min_periods=1).max().values > 0
+    sample_weights = pd.Series(np.where(excluded, 0.0, 1.0), index=frame.index)
+
+    fitted = model.fit(request, hyper_params, activity=activity, sample_weights=sample_weights)
+
+    held_out = frame[test]
+    error = held_out["delta"].values - model.predict(
+        held_out, fitted.raw_basals, fitted.raw_insulin_sensitivities, fitted.raw_carb_ratios)
+    loss = model.pinball_loss(
+        error.astype("float64"), hyper_params["quantile_loss_quantile"],
+        hyper_params.get("quantile_loss_smoothing", 0.0))
+    hour = np.asarray(held_out.index.hour)
+    stats = Fold(
+        start=str(held_out.index[0].date()), end=str(held_out.index[-1].date()),
+        loss=float(np.mean(loss)), training_loss=fitted.training_loss, rows=len(loss))
+    return (i, fold, stats, np.bincount(hour, weights=loss, minlength=24),
+            np.bincount(hour, minlength=24))
+
+
+def cross_validate_all(request, configs, folds=5, processes=None):
+    """Cross-validate each of configs (dicts of hyper parameters,
+    overriding model.default_hyper_params). The folds of all
+    configurations are fitted in a single pool of processes. Returns a
+    CrossValidation for each configuration, in order."""
+    configs = [
+        {**model.default_hyper_params, **request.hyper_params, **config}
+        for config in configs
+    ]
+    bare = dataclasses.replace(request, timeseries=[], hyper_params={})
+    tasks = [(i, config, fold, folds)
+             for i, config in enumerate(configs) for fold in range(folds)]
+    with sweep.shared_frames(request, configs) as frames, multiprocessing.Pool(
+            processes, initializer=sweep.init_worker, initargs=(bare, frames)) as pool:
+        results = [r for r in pool.map(fit_fold, tasks, chunksize=1) if r is not None]
+
+    validations = []
+    for i, config in enumerate(configs):
+        # There are fewer folds than requested if there are fewer days.
+        # A configuration may have no rows at all (e.g. if its
+        # rolling_window is longer than the data); its losses are NaN.
+        mine = sorted((r for r in results if r[0] == i), key=lambda r: r[1])
+        sums = np.zeros(24) + np.sum([r[3] for r in mine], axis=0)
+        counts = np.zeros(24) + np.sum([r[4] for r in mine], axis=0)
+        with np.errstate(invalid="ignore"):
+            hourly_loss = sums / counts
+            loss = float(np.sum(sums) / np.sum(counts))
+        validations.append(CrossValidation(
+            hyper_params=config,
+            loss=loss,
+            folds=[r[2] for r in mine],
+            hourly_loss=hourly_loss))
+    return validations
+
+
+def cross_validate(request, hyper_params=model.default_hyper_params, folds=5, processes=None):
+    """Cross-validate the model with the given hyper parameters on
+    folds of contiguous days, fitting the folds concurrently."""
+    validation, = cross_validate_all(request, [hyper_params], folds, processes)
+    return validation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", type=str, nargs="?", help="request to read")
+    parser.add_argument("--folds", type=int, default=5, help="number of folds")
+    parser.add_argument(
+        "--param", type=sweep.parse_param, action="append", default=[],
+        help="hyper parameter values to compare, as key=value,value,...")
+    parser.add_argument("--processes", type=int, help="number of worker processes")
+    args = parser.parse_args()
+
+    if args.file is None:
+        body = sys.stdin.buffer.read()
+    else:
+        with open(args.file, "rb") as input:
+            body = input.read()
+    request = codec.decode_request(body, model.frame_warmup)
+
+    configs = sweep.configurations(args.param)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        validations = cross_validate_all(request, configs, args.folds, args.processes)
+    print(f"cross-validated {len(configs)} configurations in "
+          f"{time.perf_counter() - start:.3f}s", file=sys.stderr)
+
+    keys = [key for key, _ in args.param]
+    if len(validations) == 1:
+        validation, = validations
+        print("\t".join(["fold", "start", "end", "rows", "loss", "training_loss"]))
+        for i, fold in enumerate(validation.folds):
+            print("\t".join([str(i), fold.start, fold.end, str(fold.rows),
+                             f"{fold.loss:.6g}", f"{fold.training_loss:.6g}"]))
+        print()
+        print("\t".join(["hour", "loss"]))
+        for hour, loss in enumerate(validation.hourly_loss):
+            print(f"{hour}\t{loss:.6g}")
+        print()
+        print(f"loss\t{validation.loss:.6g}")
+    else:
+        # There are fewer folds than requested if there are fewer days,
+        # which may depend on the configuration's frame_limit.
+        nfolds = max(len(validation.folds) for validation in validations)
+        print("\t".join(["rank", "loss"] + [f"fold{i}" for i in range(nfolds)] + keys))
+        ranked = sorted(
+            validations, key=lambda validation: (np.isnan(validation.loss), validation.loss))
+        for rank, validation in enumerate(ranked):
+            losses = [f"{fold.loss:.6g}" for fold in validation.folds]
+            print("\t".join(
+                [str(rank + 1), f"{validation.loss:.6g}"]
+                + losses + [""] * (nfolds - len(losses))
+                + [str(validation.hyper_params[key]) for key in keys]))
+
+
+if __name__ == "__main__":
+    main()
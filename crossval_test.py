@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import crossval
+import model
+import model_test
+
+
+class CrossValidateTest(unittest.TestCase):
+    def test_fold_days(self):
+        index = pd.date_range("2019-12-01", periods=5 * 288, freq=model.Period, tz="UTC")
+        fold = crossval.fold_days(index, 2)
+        np.testing.assert_array_equal(np.unique(fold), [0, 1])
+        # Folds are contiguous blocks of whole days.
+        self.assertTrue(np.all(np.diff(fold) >= 0))
+        np.testing.assert_array_equal(np.bincount(fold), [3 * 288, 2 * 288])
+        # There are at most as many folds as days.
+        self.assertEqual(crossval.fold_days(index, 10).max(), 4)
+
+    def test_cross_validate(self):
+        request = model_test.make_days_request(6)
+        validation = crossval.cross_validate(request, folds=3, processes=2)
+        frame = model.make_frame(request, model.default_hyper_params)
+
+        self.assertEqual(len(validation.folds), 3)
+        rows = [fold.rows for fold in validation.folds]
+        self.assertEqual(sum(rows), len(frame))
+        self.assertAlmostEqual(
+            validation.loss, np.average([fold.loss for fold in validation.folds], weights=rows))
+        self.assertEqual(validation.hourly_loss.shape, (24,))
+        self.assertTrue(np.all(np.isfinite(validation.hourly_loss)))
+        for fold in validation.folds:
+            self.assertLessEqual(fold.start, fold.end)
+
+    def test_configurations(self):
+        request = model_test.make_days_request(4)
+        configs = [{"rolling_window": 1}, {"rolling_window": 8}]
+        validations = crossval.cross_validate_all(request, configs, folds=2, processes=1)
+        self.assertEqual([v.hyper_params["rolling_window"] for v in validations], [1, 8])
+        expected = crossval.cross_validate(request, configs[1], folds=2, processes=1)
+        self.assertAlmostEqual(validations[1].loss, expected.loss)
+
+    def test_empty_configuration(self):
+        # No rows are left when the rolling window exceeds the data.
+        request = model_test.make_days_request(2)
+        configs = [{}, {"rolling_window": 3 * 288}]
+        validations = crossval.cross_validate_all(request, configs, folds=2, processes=1)
+        self.assertTrue(np.isfinite(validations[0].loss))
+        self.assertEqual(validations[1].folds, [])
+        self.assertTrue(np.isnan(validations[1].loss))
+        self.assertEqual(validations[1].hourly_loss.shape, (24,))
+        self.assertTrue(np.all(np.isnan(validations[1].hourly_loss)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,8 @@ import sys
 import numpy as np
 import pandas as pd
 
+import codec
+
 
 def allowed_basal_rates_522():
     # Cribbed from Loop.
@@ -43,31 +45,17 @@ def delta(array):
     return array - shifted
 
 
-def rle(array):
-    list = np.array(array).tolist()
-    out = []
-    i = 0
-    for j in range(1, len(list)):
-        if list[i] == list[j]:
-            continue
-        n = j - i
-        if n > 1:
-            out.append((list[i], n))
-        else:
-            out.append(list[i])
-        i = j
-    return out
-
-
-def encode(array):
+def encode(array, run_length=False):
+    if run_length:
+        return codec.rle(delta(array))
     return delta(array).tolist()
 
 
-def timeline(ctype, params, series):
+def timeline(ctype, params, series, run_length=False):
     series = series[series != 0]
     series = series[np.isfinite(series)]
-    index = encode(series.index.astype(np.int64) // 10 ** 9)
-    values = encode(series.values)
+    index = encode(series.index.astype(np.int64) // 10 ** 9, run_length)
+    values = encode(series.values, run_length)
 
     return {
         "type": ctype,
@@ -81,6 +69,15 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("file", type=str, nargs="?", help="file to convert")
     parser.add_argument("--output", type=str, help="output to file")
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["json", "columnar"],
+        default="json",
+        help="request encoding",
+    )
+    parser.add_argument(
+        "--rle", action="store_true", help="run-length encode timelines")
 
     args = parser.parse_args()
     input = args.file
@@ -96,74 +93,80 @@ def main():
             "values": list(values),
         }
 
-    payload = json.dumps(
-        {
-            "version": 1,
-            "timezone": "US/Pacific",
-            # These are all for Medtronic 522.
-            "minimum_time_interval": 30 * 60,
-            "maximum_schedule_item_count": 48,
-            "allowed_basal_rates": allowed_basal_rates_522(),
-            # Sydney Humalog
-            "basal_insulin_parameters": {
-                "delay": 1.001781489035799 * 5.0,
-                "peak": 13.034515673823211 * 5.0,
-                "duration": 40.73599998325823 * 5.0,
-            },
-            "timelines": [
-                timeline("glucose", {}, frame["sgv"]),
-                timeline(
-                    "insulin",
-                    {"delay": 5, "peak": 65, "duration": 205},
-                    frame["insulin_humalog"],
-                ),
-                timeline(
-                    "insulin",
-                    {"delay": 8, "peak": 44, "duration": 200},
-                    frame["insulin_fiasp"],
-                ),
-                timeline(
-                    "carb", {"delay": 10, "duration": 30}, frame["uciXS"]),
-                timeline("carb", {"delay": 15, "duration": 60}, frame["uciS"]),
-                timeline(
-                    "carb", {"delay": 15, "duration": 120}, frame["uciM"]),
-                timeline(
-                    "carb", {"delay": 15, "duration": 180}, frame["uciL"]),
-            ],
-            "insulin_sensitivity_schedule": make_schedule(
-                (0, 140),
-                (3*60, 140),
-                (6*60, 100),
-                (8*60, 90),
-                (12*60, 100),
-                (15*60, 120),
-                (22*60, 140),
-            ),
-            "basal_rate_schedule": make_schedule(
-                (0, 0.2),
-                (3*60, 0.1),
-                (6*60, 0.5),
-                (10*60, 0.3),
-                (14*60, 0.25),
-                (17*60, 0.20),
-                (20*60, 0.15),
+    payload = {
+        # Version 2 permits run-length encoding.
+        "version": 2 if args.rle else 1,
+        "timezone": "US/Pacific",
+        # These are all for Medtronic 522.
+        "minimum_time_interval": 30 * 60,
+        "maximum_schedule_item_count": 48,
+        "allowed_basal_rates": allowed_basal_rates_522(),
+        # Sydney Humalog
+        "basal_insulin_parameters": {
+            "delay": 1.001781489035799 * 5.0,
+            "peak": 13.034515673823211 * 5.0,
+            "duration": 40.73599998325823 * 5.0,
+        },
+        "timelines": [
+            timeline("glucose", {}, frame["sgv"], args.rle),
+            timeline(
+                "insulin",
+                {"delay": 5, "peak": 65, "duration": 205},
+                frame["insulin_humalog"],
+                args.rle,
             ),
-            #            "carb_ratio_schedule": {"index": [72, 120, 216], "values": [8, 15, 18],},
-            "carb_ratio_schedule": make_schedule(
-                (0, 15),
-                (7*60, 8),
-                (9*60, 14),
-                (19*60, 20),
+            timeline(
+                "insulin",
+                {"delay": 8, "peak": 44, "duration": 200},
+                frame["insulin_fiasp"],
+                args.rle,
             ),
-            "tuning_limit": 0.35,
-        }
-    )
+            timeline(
+                "carb", {"delay": 10, "duration": 30}, frame["uciXS"], args.rle),
+            timeline(
+                "carb", {"delay": 15, "duration": 60}, frame["uciS"], args.rle),
+            timeline(
+                "carb", {"delay": 15, "duration": 120}, frame["uciM"], args.rle),
+            timeline(
+                "carb", {"delay": 15, "duration": 180}, frame["uciL"], args.rle),
+        ],
+        "insulin_sensitivity_schedule": make_schedule(
+            (0, 140),
+            (3*60, 140),
+            (6*60, 100),
+            (8*60, 90),
+            (12*60, 100),
+            (15*60, 120),
+            (22*60, 140),
+        ),
+        "basal_rate_schedule": make_schedule(
+            (0, 0.2),
+            (3*60, 0.1),
+            (6*60, 0.5),
+            (10*60, 0.3),
+            (14*60, 0.25),
+            (17*60, 0.20),
+            (20*60, 0.15),
+        ),
+        #            "carb_ratio_schedule": {"index": [72, 120, 216], "values": [8, 15, 18],},
+        "carb_ratio_schedule": make_schedule(
+            (0, 15),
+            (7*60, 8),
+            (9*60, 14),
+            (19*60, 20),
+        ),
+        "tuning_limit": 0.35,
+    }
+    if args.format == "columnar":
+        output = codec.dumps_columnar(payload)
+    else:
+        output = json.dumps(payload).encode("utf-8")
 
     if args.output is None:
-        sys.stdout.write(payload)
+        sys.stdout.buffer.write(output)
     else:
-        with open(args.output) as file:
-            file.write(payload)
+        with open(args.output, "wb") as file:
+            file.write(output)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,24 @@
-import json
+import dataclasses
 import logging
+import os
 
 from flask import Flask, jsonify, request
 
 import codec
 import model
+import store
 
 app = Flask(__name__)
 
+# The store of users' timelines; see /ingest and /fit. The store is a
+# local directory: the default is on the instance's own disk, which
+# (on App Engine flex) is neither shared among instances nor kept
+# across restarts, so TUNE_STORE should name a persistent, shared
+# mount for the stored timelines to survive.
+user_store = store.Store(os.environ.get("TUNE_STORE", "/tmp/tune-store"))
 
-def response(request, model):
+
+def response(request, model, confidence_intervals=None):
     return codec.Response(
         version=1,
         timezone="unavailable",
@@ -20,42 +29,136 @@ def response(request, model):
         basal_rate_schedule=codec.Schedule.fromtuple(
             model.params["basal_rate_schedule"]),
         training_loss=-1.,
+        tuned_parameters=model.tuned_parameters,
+        confidence_intervals=confidence_intervals,
     )
 
 
+# Bounds on the bootstrap replicates that a request may ask for, and
+# on the wall time (in seconds) spent fitting them.
+max_bootstrap_replicates = 200
+max_bootstrap_time_limit = 30.0
+
+
+def confidence_intervals(user_request, activity=None):
+    """Bootstrap confidence intervals for the request's schedules, if
+    its hyper parameters ask for them (see bootstrap.intervals). The
+    number of replicates, and the time spent fitting them, are capped."""
+    hyper_params = dict(model.default_hyper_params, **user_request.hyper_params)
+    if hyper_params["bootstrap_replicates"] <= 0:
+        return None
+    time_limit = hyper_params["bootstrap_time_limit"]
+    if time_limit <= 0 or time_limit > max_bootstrap_time_limit:
+        time_limit = max_bootstrap_time_limit
+    hyper_params.update(
+        bootstrap_replicates=min(hyper_params["bootstrap_replicates"], max_bootstrap_replicates),
+        bootstrap_time_limit=time_limit)
+    # The request's hyper parameters take precedence in bootstrap.intervals.
+    user_request = dataclasses.replace(user_request, hyper_params=hyper_params)
+    # Imported here since bootstrap (through sweep) needs
+    # multiprocessing.shared_memory, which was added in Python 3.8.
+    import bootstrap
+    intervals, _ = bootstrap.intervals(user_request, hyper_params, activity=activity)
+    return intervals
+
+
+# The errors raised when decoding a malformed request. (JSON decoding
+# errors are ValueErrors.)
+decode_errors = (ValueError, codec.FormatError, codec.VersionError, codec.MissingFieldError)
+
+
+def decode_request():
+    """Decode the body of the current request in the encoding given by
+    its content type, or return None if the encoding is not supported
+    or the request is malformed."""
+    try:
+        if request.mimetype == codec.columnar_content_type:
+            return codec.Request.frombytes(request.get_data(), model.frame_warmup)
+        if request.is_json:
+            return codec.Request.fromdict(codec.loads(request.get_data()), model.frame_warmup)
+    except decode_errors as e:
+        logging.info(f"invalid payload: {e}")
+    return None
+
+
 @app.route("/standard", methods=["POST"])
 def standard():
-    payload = request.json
-    if payload is None:
+    user_request = decode_request()
+    if user_request is None:
         return "invalid payload", 400
 
-    user_request = codec.Request.fromdict(payload)
     fitted_model = model.fit(user_request)
 
-    return jsonify(response(user_request, fitted_model).todict())
+    return jsonify(response(
+        user_request, fitted_model, confidence_intervals(user_request)).todict())
 
 
 @app.route("/sydney", methods=["POST"])
 def sydney():
-    payload = request.json
-    if payload is None:
+    user_request = decode_request()
+    if user_request is None:
         return "invalid payload", 400
 
-#    with open("/tmp/request.json", "w") as file:
-#        json.dump(payload, file)
-
-    user_request = codec.Request.fromdict(payload)
-
     # TODO: merge this once we have enough Loop data.
 
     with open("sydney2019-11-20.json") as file:
-        canned_payload = json.load(file)
+        canned_payload = codec.load(file)
         canned_request = codec.Request.fromdict(canned_payload)
         user_request.timeseries = canned_request.timeseries
 
     fitted_model = model.fit(user_request)
 
-    return jsonify(response(user_request, fitted_model).todict())
+    return jsonify(response(
+        user_request, fitted_model, confidence_intervals(user_request)).todict())
+
+
+@app.route("/ingest/<user_id>", methods=["POST"])
+def ingest(user_id):
+    """Append the timelines of the request (in either encoding) to the
+    user's store."""
+    user_request = decode_request()
+    if user_request is None:
+        return "invalid payload", 400
+    try:
+        user_store.append(user_id, user_request)
+    except store.StoreError as e:
+        return str(e), 400
+    return "", 204
+
+
+@app.route("/fit/<user_id>", methods=["POST"])
+def fit(user_id):
+    """Fit a model to the user's stored timelines between the optional
+    start and end query parameters (Unix seconds), further restricted by
+    the frame_limit hyper parameter. The (JSON) body is
+    a request without timelines; its timezone defaults to the one of
+    the most recently ingested timelines."""
+    try:
+        payload = codec.loads(request.get_data()) if request.get_data() else {}
+    except ValueError:
+        return "invalid payload", 400
+    if not isinstance(payload, dict):
+        return "invalid payload", 400
+    start, end = request.args.get("start", type=int), request.args.get("end", type=int)
+    try:
+        meta = user_store.meta(user_id)
+        if meta is None:
+            raise store.StoreError(f"no data for user {user_id}")
+        payload = dict(payload, timelines=[])
+        payload.setdefault("version", 1)
+        payload.setdefault("timezone", meta["timezone"])
+        user_request = codec.Request.fromdict(payload)
+        hyper_params = dict(model.default_hyper_params, **user_request.hyper_params)
+        activity = user_store.activity(
+            user_id, start, end, dtype=hyper_params["precision"],
+            warmup=model.frame_warmup(hyper_params), frame_limit=hyper_params["frame_limit"])
+    except (store.StoreError,) + decode_errors as e:
+        return str(e), 400
+
+    fitted_model = model.fit(user_request, activity=activity)
+
+    return jsonify(response(
+        user_request, fitted_model, confidence_intervals(user_request, activity)).todict())
 
 
 @app.errorhandler(500)
@@ -1,3 +1,5 @@
+import numpy as np
+
 import main
 
 def test_index():
@@ -7,3 +9,88 @@ def test_index():
     r = client.get('/')
     assert r.status_code == 200
     assert '[[19 22]\n [43 50]]' in r.data.decode('utf-8')
+
+
+def test_ingest_fit(tmp_path):
+    import codec
+    import model_test
+    import store
+
+    main.app.testing = True
+    main.user_store = store.Store(str(tmp_path))
+    client = main.app.test_client()
+
+    request = model_test.make_days_request(2)
+    payload = {
+        "version": 1,
+        "timezone": "UTC",
+        "timelines": [
+            {
+                "type": col.ctype,
+                "parameters": col.meta,
+                "index": codec.tolist(np.diff(col.seconds, prepend=0)),
+                "values": codec.tolist(np.diff(col.values, prepend=0)),
+            }
+            for col in request.timeseries
+        ],
+    }
+    r = client.post("/ingest/user", json=payload)
+    assert r.status_code == 204
+
+    start = int(request.timeseries[0].seconds[288])
+    r = client.post(f"/fit/user?start={start}", json={
+        "tuning_limit": 0.3,
+        "basal_insulin_parameters": {"delay": 5, "peak": 65, "duration": 205},
+    })
+    assert r.status_code == 200
+    assert "basal_rate_schedule" in r.get_json()
+    assert "confidence_intervals" not in r.get_json()
+
+    r = client.post("/fit/user", json={
+        "basal_insulin_parameters": {"delay": 5, "peak": 65, "duration": 205},
+        "hyper_params": {"bootstrap_replicates": 2},
+    })
+    assert r.status_code == 200
+    intervals = r.get_json()["confidence_intervals"]
+    assert len(intervals["basal_rate_schedule"]["upper"]) == 24
+
+    r = client.post("/fit/nobody", json={})
+    assert r.status_code == 400
+
+    for body in [{"version": 3}, {"timezone": None}]:
+        r = client.post("/fit/user", json=body)
+        assert r.status_code == 400, body
+
+
+def test_invalid_payload():
+    main.app.testing = True
+    client = main.app.test_client()
+
+    for body in ['{"version": 2, "timezone": "UTC", "timelines": [{"index": [[1, -1]]}]}',
+                 '{"version": 1, "timezone": "UTC", "timelines": [{"index": [1.]}]}',
+                 '{"version": 1, "timelines": []}',
+                 '{"version": 1, "timezone": "UTC", "timelines": [{"index": [1], "values": [1]}]}',
+                 '{"version": 1, "timezone": "UTC", "timelines": [{"type": "x", "index": [1], "values": [1]}]}',
+                 '{"version": 1, "timezone": "UTC", "timelines": [{"type": "basal"}]}',
+                 '{"version": 1, "timezone": "UTC", "timelines": [1]}',
+                 '{"version": 1']:
+        r = client.post("/standard", data=body, content_type="application/json")
+        assert r.status_code == 400, body
+
+
+def test_confidence_interval_limits(monkeypatch):
+    import bootstrap
+    import codec
+
+    requested = []
+
+    def intervals(request, hyper_params, activity=None):
+        requested.append(request.hyper_params)
+        return None, 0
+
+    monkeypatch.setattr(bootstrap, "intervals", intervals)
+    main.confidence_intervals(codec.Request(
+        timezone="UTC", timeseries=[], hyper_params={"bootstrap_replicates": 10 ** 6}))
+    hyper_params, = requested
+    assert hyper_params["bootstrap_replicates"] == main.max_bootstrap_replicates
+    assert hyper_params["bootstrap_time_limit"] == main.max_bootstrap_time_limit
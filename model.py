@@ -1,17 +1,23 @@
 import argparse
 import bisect
+import collections
 import dataclasses
+import functools
+import hashlib
 import json
 import logging
 import math
 import sys
-from dataclasses import dataclass
-from typing import Any, Callable, Dict, Tuple
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
 
 import autograd.numpy as np
+from autograd import value_and_grad
 import pandas as pd
-from scipy import optimize
-from scipy.ndimage.interpolation import shift
+from scipy import optimize, signal, sparse
+from scipy.ndimage import shift
 
 import codec
 import train
@@ -23,6 +29,12 @@ import train
 Whoriz = 12 * 6
 Wtime = np.linspace(0.0, 1.0 * Whoriz, Whoriz, endpoint=False, dtype="float32")
 Period = "5min"
+PeriodSeconds = 5 * 60
+
+
+# The parameter schedules of a model, in the order of their
+# (instantaneous) parameters.
+schedule_names = ["basal_rate_schedule", "insulin_sensitivity_schedule", "carb_ratio_schedule"]
 
 
 @dataclass
@@ -35,41 +47,107 @@ class Model:
 
     training_loss: float
 
+    # The schedules that were fitted; the others are as in the request.
+    tuned_parameters: List[str] = field(default_factory=lambda: list(schedule_names))
 
-def resample(frame):
-    first, last = None, None
+    # Optimizer statistics: wall time, iterations, and loss evaluations.
+    stats: Dict[str, Any] = field(default_factory=dict)
 
-    for col in frame.timeseries:
-        index = col.series.index
-        if first is None:
-            first = index[0]
-            last = index[len(index) - 1]
-            continue
 
-        if index[0] < first:
-            first = index[0]
-        if index[len(index) - 1] > last:
-            last = index[len(index) - 1]
+def first_by_bucket(buckets, values, nbucket):
+    """Select the first non-NaN value in each bucket, given values in
+    time order; buckets without any values are NaN."""
+    out = np.full(nbucket, math.nan)
+    keep = ~np.isnan(values)
+    unique, first = np.unique(buckets[keep], return_index=True)
+    out[unique] = values[keep][first]
+    return out
+
 
-    print('FIRST', 'LAST', first, last)
-    pad = pd.Series(0, pd.DatetimeIndex([first, last]))
+def resample_grid(frame, period=PeriodSeconds):
+    """Resample every timeline in the frame onto a single shared grid
+    of period-second buckets spanning all of the frame's timelines.
+    Returns the timestamps (in Unix seconds) of the grid, and an
+    aligned array of values for each timeline."""
+    first = min(np.min(col.seconds) for col in frame.timeseries) // period
+    last = max(np.max(col.seconds) for col in frame.timeseries) // period
+    nbucket = last - first + 1
 
-    timeseries = []
-    for i, col in enumerate(frame.timeseries):
+    grids = []
+    for col in frame.timeseries:
+        buckets = col.seconds // period - first
+        values = np.asarray(col.values, dtype="float64")
         if col.ctype == "glucose":
             # Glucose is a "level" column, so we fill in missing
             # values with NaNs.
-            resampled = col.series.resample(Period).first()
+            order = np.argsort(col.seconds, kind="stable")
+            grid = first_by_bucket(buckets[order], values[order], nbucket)
         else:
-            # Carb and insulin deliveries are additive, and we pad the series
-            # so that they are defined for the full timespan of the frame.
-            series = col.series.combine_first(pad)
-            resampled = series.resample(Period)
-            resampled = resampled.sum()
+            # Carb and insulin deliveries are additive, and are
+            # defined (zero if absent) for the full timespan of the frame.
+            grid = np.bincount(
+                buckets, weights=np.nan_to_num(values), minlength=nbucket)
+        grids.append(grid)
+
+    return (first + np.arange(nbucket)) * period, grids
+
+
+def resample(frame, dtype="float64"):
+    """Resample the frame's timelines onto a shared grid (see
+    resample_grid), with values of the given dtype."""
+    seconds, grids = resample_grid(frame)
+    timeseries = [
+        codec.Timeseries.fromarrays(
+            col.ctype, col.meta, seconds, grid.astype(dtype, copy=False), frame.timezone)
+        for col, grid in zip(frame.timeseries, grids)
+    ]
+    return dataclasses.replace(frame, timeseries=timeseries)
 
-        timeseries.append(codec.Timeseries(col.ctype, col.meta, resampled))
 
-    return dataclasses.replace(frame, timeseries=timeseries)
+# Kernels at least this long are convolved with FFTs; shorter kernels
+# (including the standard Whoriz-long curves) are faster to convolve
+# directly.
+fft_min_window = 256
+
+
+def convolve(values, coeffs, dtype="float64"):
+    """Apply the curve coeffs to trailing deliveries: entry i of the
+    result is the dot product of values[i-len(coeffs)+1:i+1] with the
+    reversed coefficients. This is the same computation as a
+    rolling(window=len(coeffs)) dot product, and matches its NaN
+    handling: the first len(coeffs)-1 entries, and any entry whose
+    window contains a NaN, are NaN. Values and coeffs may also be 2-D,
+    in which case each row of values is convolved with the
+    corresponding row of coeffs. The convolution is computed in the
+    given dtype."""
+    values = np.asarray(values, dtype=dtype)
+    coeffs = np.asarray(coeffs, dtype=dtype)
+    window = coeffs.shape[-1]
+    n = values.shape[-1]
+
+    missing = np.isnan(values)
+    if missing.any():
+        values = np.where(missing, 0.0, values)
+
+    if window >= fft_min_window and n > window:
+        out = signal.oaconvolve(values, coeffs, axes=-1)[..., :n]
+        # FFT round-off leaves tiny residues where the exact result is
+        # zero; snap these back so that, e.g., "carb > 0" filters
+        # behave the same as with direct convolution.
+        tol = 1e-12 * np.finfo(dtype).eps / np.finfo("float64").eps * \
+            np.max(np.abs(values), initial=0.0) * np.max(np.sum(np.abs(coeffs), axis=-1))
+        out[np.abs(out) <= tol] = 0.0
+    elif values.ndim == 1:
+        out = np.convolve(values, coeffs)[:n]
+    else:
+        out = np.stack([np.convolve(v, c)[:n] for v, c in zip(values, coeffs)])
+
+    out[..., : window - 1] = math.nan
+    if missing.any():
+        nmissing = np.cumsum(missing, axis=-1)
+        nmissing[..., window:] -= nmissing[..., :-window].copy()
+        out[nmissing > 0] = math.nan
+    return out
 
 
 def expia1(t, delay, tp, td):
@@ -86,31 +164,36 @@ def expia1(t, delay, tp, td):
     return np.maximum(0.0, (S / np.power(tau, 2)) * t * (1 - t / td) * np.exp(-t / tau))
 
 
-def apply_insulin_curve(column):
+def insulin_activity(column):
     assert column.ctype in ["insulin", "basal", "bolus"]
 
-    coeffs = expia1(
-        Wtime,
-        column.meta["delay"] / 5,
-        column.meta["peak"] / 5,
-        column.meta["duration"] / 5,
-    )
-    # We flip them because we're going to be applying these to
-    # "trailing" data.
-    coeffs = np.flip(coeffs, 0)
-
+    coeffs = curve_coeffs(*curve_params(column))
     # ia indicates insulin activity. This is computed by adding up
     # the contributions of each delivery over a rolling window.
-    # Conveniently, this is equivalent to taking the dot product of
-    # the deliveries in the window with the coefficients computed
-    # above.
-    return column.series.rolling(window=Whoriz).apply(
-        lambda pids: np.dot(pids, coeffs), raw=True
-    )
+    # Conveniently, this is equivalent to convolving the deliveries
+    # with the coefficients computed above.
+    return convolve(column.values, coeffs)
+
+
+def apply_insulin_curve(column):
+    return pd.Series(insulin_activity(column), column.series.index)
+
+
+def curve_grid(t, *params):
+    """Broadcast the time grid t against curve parameters. When all
+    parameters are scalars, the curve is evaluated over t; when any are
+    1-D arrays, one curve is evaluated per parameter entry, so that
+    curves are returned as the rows of a [len(params), len(t)] matrix."""
+    t = np.asarray(t, dtype="float64")
+    params = [np.asarray(p, dtype="float64") for p in params]
+    if all(np.ndim(p) == 0 for p in params):
+        return [t] + params
+    return [np.reshape(t, (1, -1))] + [np.reshape(p, (-1, 1)) for p in params]
 
 
 def walshca(t, tdel, tdur):
     """Walsh carb absorption curves with provided delays and duration."""
+    t, tdel, tdur = curve_grid(t, tdel, tdur)
     return ((t >= tdel) & (t <= tdel + tdur / 2)) * (
         4 * (t - tdel) / np.square(tdur)
     ) + ((t > tdel + tdur / 2) & (t <= tdel + tdur)) * (
@@ -119,66 +202,167 @@ def walshca(t, tdel, tdur):
 
 
 def dm61_nonlinear(t, tdel, tdur, percent_end_of_rise=0.15, percent_start_of_fall=0.5):
+    """Nonlinear carb absorption curves due to Dragan Maksimovic
+    (@dm61): absorption rises quadratically, continues linearly, and
+    tapers off quadratically. The returned coefficients are the
+    fraction of carbs absorbed in each period, starting after tdel."""
+    t, tdel, tdur = curve_grid(t, tdel, tdur)
     scale = 2. / (1. + percent_start_of_fall - percent_end_of_rise)
-    percent_time = t/tdur
-
-    def percent_absorbed(t):
-        if t < 0.:
-            return 0.
-        if t < percent_end_of_rise:
-            return 0.5*scale*math.pow(t, 2.0) / percent_end_of_rise
-        if t >= percent_end_of_rise and t < percent_start_of_fall:
-            return scale * (t - 0.5*percent_end_of_rise)
-        if t >= percent_start_of_fall and t < 1.0:
-            return scale * (percent_start_of_fall - 0.5 * percent_end_of_rise +
-                            (t - percent_start_of_fall) *
-                            (1.0 - 0.5 * (t - percent_start_of_fall) / (1.0 - percent_start_of_fall)))
-        return 1.0
-
-    absorbed = np.array([percent_absorbed(t) for t in percent_time])
-    shifted = np.zeros_like(absorbed)
-    shifted[1:] = absorbed[:len(absorbed)-1]
-    coeffs = absorbed - shifted
-    return coeffs
+    percent_time = (t - tdel) / tdur
+
+    rise = 0.5 * scale * np.square(percent_time) / percent_end_of_rise
+    linear = scale * (percent_time - 0.5 * percent_end_of_rise)
+    fall = scale * (percent_start_of_fall - 0.5 * percent_end_of_rise +
+                    (percent_time - percent_start_of_fall) *
+                    (1.0 - 0.5 * (percent_time - percent_start_of_fall) / (1.0 - percent_start_of_fall)))
+    absorbed = np.where(
+        percent_time < 0., 0.,
+        np.where(percent_time < percent_end_of_rise, rise,
+                 np.where(percent_time < percent_start_of_fall, linear,
+                          np.where(percent_time < 1.0, fall, 1.0))))
+    # Round off the noise from differencing so that the linear phase
+    # has exactly constant absorption.
+    return np.round(np.diff(absorbed, axis=-1, prepend=0.), 12)
 
 
 carb_curve = dm61_nonlinear
 
 
-def apply_carb_curve(column):
+class CurveCache:
+    """CurveCache memoizes curve coefficients, keyed by curve kind,
+    curve parameters (in minutes), horizon (in periods), and
+    resolution (minutes per period). The cache holds at most maxsize
+    entries, evicting the least recently used. It is safe for
+    concurrent use. Cached arrays are read-only, since they are
+    shared among all callers."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind, params, horizon=Whoriz, resolution=5):
+        key = (kind, tuple(float(p) for p in params), horizon, resolution)
+        with self._lock:
+            coeffs = self._entries.get(key)
+            if coeffs is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return coeffs
+            self.misses += 1
+
+        t = np.arange(horizon, dtype="float32")
+        params = [p / resolution for p in key[1]]
+        if kind == "insulin":
+            coeffs = expia1(t, *params)
+        elif kind == "carb":
+            coeffs = carb_curve(t, *params)
+        else:
+            raise ValueError(f"unknown curve kind {kind}")
+        coeffs = np.array(coeffs)
+        coeffs.setflags(write=False)
+
+        with self._lock:
+            self._entries[key] = coeffs
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return coeffs
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+curve_cache = CurveCache()
+
+
+def curve_coeffs(kind, params, horizon=Whoriz, resolution=5):
+    """Return the (read-only) coefficients of the curve of the given
+    kind ("insulin" or "carb") over horizon periods. Params are the
+    curve parameters, in minutes: (delay, peak, duration) for insulin
+    curves and (delay, duration) for carb curves."""
+    return curve_cache.get(kind, params, horizon=horizon, resolution=resolution)
+
+
+def carb_activity(column):
     assert column.ctype == "carb"
 
-    coeffs = carb_curve(
-        Wtime, column.meta["delay"] / 5, column.meta["duration"] / 5)
-    coeffs = np.flip(coeffs, 0)
+    coeffs = curve_coeffs(*curve_params(column))
+    return convolve(column.values, coeffs)
 
-    return column.series.rolling(window=Whoriz).apply(
-        lambda ucis: np.dot(ucis, coeffs), raw=True
-    )
 
+def apply_carb_curve(column):
+    return pd.Series(carb_activity(column), column.series.index)
+
+
+def curve_params(column):
+    """Return the curve (kind and parameters) that applies to the
+    deliveries in the column."""
+    if column.ctype == "carb":
+        return "carb", (column.meta["delay"], column.meta["duration"])
+    return "insulin", (column.meta["delay"], column.meta["peak"], column.meta["duration"])
 
-def make_pandas_frame(frame):
-    # Iterate through the columns, transforming them,
-    # return a combined data frame.
 
-    empty_index = pd.to_datetime([], unit="s", utc=True)
-    empty_index = empty_index.tz_convert(frame.timezone)
-    empty = pd.Series([], index=empty_index)
+def activity(deliveries, dtype="float64"):
+    """Compute total activity given deliveries, a dict mapping curves
+    (see curve_params) to deliveries on a shared grid. All curves
+    are convolved in a single batch, in the given dtype."""
+    if not deliveries:
+        return None
+    curves = list(deliveries)
+    coeffs = np.stack([curve_coeffs(kind, params) for kind, params in curves])
+    values = np.stack([deliveries[curve] for curve in curves])
+    return np.sum(convolve(values, coeffs, dtype=dtype), axis=0)
 
-    insulin, carb, glucose = empty, empty, empty
+
+def make_pandas_frame(frame, dtype="float64"):
+    # Iterate through the columns, transforming them,
+    # return a combined data frame. The columns must have
+    # been resampled onto a shared index (see resample).
+    # Columns are computed in, and have, the given dtype.
+    index = pd.to_datetime(frame.timeseries[0].seconds, unit="s", utc=True)
+    index = index.tz_convert(frame.timezone)
+    insulin, carb, glucose = {}, {}, None
 
     for series in frame.timeseries:
         if series.ctype in ["insulin", "basal", "bolus"]:
-            insulin = insulin.add(apply_insulin_curve(
-                series) / 1000.0, fill_value=0)
+            deliveries = insulin
         elif series.ctype == "carb":
-            carb = carb.add(apply_carb_curve(series), fill_value=0)
+            deliveries = carb
         elif series.ctype == "glucose":
-            glucose = glucose.combine_first(series.series)
+            # Earlier glucose timelines take precedence.
+            values = np.asarray(series.values, dtype=dtype)
+            glucose = values if glucose is None else np.where(
+                np.isnan(glucose), values, glucose)
+            continue
+        else:
+            raise Exception(f"unknown column type {series.ctype}")
+
+        # Since activity is linear in deliveries, timelines that share
+        # a curve can be summed and convolved once.
+        curve = curve_params(series)
+        if curve in deliveries:
+            deliveries[curve] = deliveries[curve] + series.values
         else:
-            raise Exception(f"unknown column type {coseriesl.ctype}")
+            deliveries[curve] = series.values
 
-    return pd.DataFrame({"insulin": insulin, "carb": carb, "glucose": glucose, })
+    insulin, carb = activity(insulin, dtype), activity(carb, dtype)
+    if insulin is not None:
+        insulin = insulin / 1000.0
+
+    missing = np.full(len(index), math.nan, dtype=dtype)
+    return pd.DataFrame({
+        "insulin": missing if insulin is None else insulin,
+        "carb": missing if carb is None else carb,
+        "glucose": missing if glucose is None else glucose,
+    }, index=index)
 
 
 default_hyper_params = {
@@ -188,18 +372,97 @@ default_hyper_params = {
     "delta_window": 1,
     # Rolling window of all inputs.
     "rolling_window": 8,
-    "frame_limit": None,
+    # If positive, only the most recent frame_limit days of data are
+    # used. This may also be a [start, end] pair of Unix timestamps.
+    "frame_limit": 0.0,
     "quantile_loss_quantile": 0.5,
+    # If positive, the pinball loss is smoothed over errors of about
+    # this magnitude, so that it is differentiable everywhere.
+    "quantile_loss_smoothing": 0.0,
+    # Either "quantile" (see above), or "squared", whose loss is
+    # computed from per-hour sufficient statistics gathered once, so
+    # that each evaluation is independent of the length of history.
+    "loss": "quantile",
+    # One of "scipy.minimize", "adam", or "linprog".
     "optimizer": "scipy.minimize",
+    # The maximum number of alternations of the linprog optimizer.
+    "linprog_iterations": 10,
+    # How scipy.minimize computes gradients: "autograd" for exact
+    # gradients, or a scipy finite difference scheme (e.g. "2-point").
+    "gradient": "autograd",
+    # The fraction of the most recent data that the adam optimizer
+    # holds out to decide when to stop early; 0 to train on all data.
+    "holdout_fraction": 0.0,
+    # The precision of frames and of loss evaluation: "float64", or
+    # "float32", which halves their memory (and memory bandwidth) on
+    # long histories. Sums are accumulated in float64 either way.
+    "precision": "float64",
+    # Confidence intervals for the fitted schedules (see bootstrap.py):
+    # the number of bootstrap replicates (0 to skip them); the
+    # confidence level of the intervals; the length, in days, of the
+    # resampled blocks; and a wall time limit in seconds (0 for none),
+    # after which the intervals use the replicates completed so far.
+    "bootstrap_replicates": 0,
+    "bootstrap_confidence": 0.9,
+    "bootstrap_block_days": 1,
+    "bootstrap_time_limit": 0.0,
 }
 
 
-def make_frame(request, hyper_params=default_hyper_params):
-    frame = resample(request)
+def frame_warmup(hyper_params=default_hyper_params):
+    """The number of seconds of data retained before the start of a
+    window selected by frame_limit, so that insulin and carb activity
+    (which depends on Whoriz periods of deliveries), as well as the
+    delta and rolling windows over the frame, are fully warmed up when
+    the window begins."""
+    hyper_params = {**default_hyper_params, **hyper_params}
+    periods = Whoriz + hyper_params["delta_window"] + hyper_params["rolling_window"]
+    return periods * PeriodSeconds
+
+
+def activity_key(hyper_params):
+    """The hyper parameters that determine the activity frame: the
+    frame limit and precision, and the warm-up (see frame_warmup) if
+    there is a frame limit."""
+    frame_limit = hyper_params.get("frame_limit")
+    return (frame_limit, hyper_params.get("precision", "float64"),
+            frame_warmup(hyper_params) if frame_limit else None)
+
+
+def limit_frame(frame, frame_limit, warmup=None):
+    """Restrict the frame's timelines to the window selected by
+    frame_limit (see codec.frame_window), as well as warmup seconds
+    before it (by default, the frame_warmup of the default hyper
+    parameters). Returns the frame, and the start of the window (in
+    Unix seconds), or None if frame_limit is unset."""
+    if not frame_limit or not frame.timeseries:
+        return frame, None
+    if warmup is None:
+        warmup = frame_warmup()
+    last = max(np.max(col.seconds) for col in frame.timeseries)
+    start, end = codec.frame_window(frame_limit, last)
+    timeseries = [col.window(start - warmup, end) for col in frame.timeseries]
+    return dataclasses.replace(
+        frame, timeseries=[col for col in timeseries if len(col) > 0]), start
+
+
+def activity_frame(request, frame_limit=None, dtype="float64", warmup=None):
+    """Resample the request and compute its insulin and carb activity:
+    the expensive part of make_frame, which depends only on the
+    request and frame_limit (with its warm-up). Returns the frame, and
+    the start of the frame limit's window (see limit_frame)."""
+    # Data outside of the frame limit are dropped before resampling.
+    request, start = limit_frame(request, frame_limit, warmup)
+    frame = resample(request, dtype)
     print('resample', frame)
-    frame = make_pandas_frame(frame)
+    frame = make_pandas_frame(frame, dtype)
     print('pandas', frame)
+    return frame, start
+
 
+def delta_stage(activity, hyper_params):
+    frame, start = activity
+    frame = frame.copy()
     frame["delta"] = frame["glucose"] - frame["glucose"].shift(1)
     print('delta', frame['delta'])
     maxdelta = hyper_params.get("maxdelta", 10)
@@ -213,9 +476,14 @@ def make_frame(request, hyper_params=default_hyper_params):
             frame["delta"]
             .rolling(window=hyper_params["delta_window"], min_periods=1)
             .mean()
+            .astype(frame["glucose"].dtype)
         )
-
     print('delta33', frame['delta'])
+    return frame, start
+
+
+def rolling_stage(delta, hyper_params):
+    frame, start = delta
     win = hyper_params.get("rolling_window")
     if win > 1:
         # Compute endpoint deltas directly so we have more data points to
@@ -225,8 +493,17 @@ def make_frame(request, hyper_params=default_hyper_params):
         # frame['ca'] = frame['ca'].rolling(window=win).mean()
         # frame['ia'] = frame['ia'].rolling(window=win).mean()
 
-        frame = frame.rolling(window=win).mean()
+        # Rolling means accumulate in float64, and are then restored
+        # to the frame's precision.
+        frame = frame.rolling(window=win).mean().astype(frame.dtypes)
+
+    if start is not None:
+        # Drop the warm-up period.
+        frame = frame[frame.index >= pd.Timestamp(start, unit="s", tz="UTC")]
+    return frame
+
 
+def finite_stage(frame, hyper_params):
     rows = (
         np.isfinite(frame["delta"])
         & np.isfinite(frame["carb"])
@@ -249,6 +526,151 @@ def make_frame(request, hyper_params=default_hyper_params):
     return frame
 
 
+# FrameStage is a stage of make_frame: a function of the previous
+# stage's result (the request, for the first stage) and the hyper
+# parameters it reads (or a function of the hyper parameters that
+# returns the values its result depends on).
+FrameStage = collections.namedtuple("FrameStage", ["name", "hyper_params", "fn"])
+
+frame_stages = [
+    FrameStage(
+        "activity", activity_key,
+        lambda request, hyper_params: activity_frame(
+            request, hyper_params.get("frame_limit"),
+            hyper_params.get("precision", "float64"), frame_warmup(hyper_params))),
+    FrameStage(
+        "delta", ("maxdelta", "maxdelta_replace", "delta_window"), delta_stage),
+    FrameStage("rolling", ("rolling_window",), rolling_stage),
+    FrameStage("finite", (), finite_stage),
+]
+
+
+def request_fingerprint(request):
+    """A digest of the request's timelines, which are the only part of
+    a request that make_frame reads."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(request.timezone).encode())
+    for col in request.timeseries:
+        values = np.ascontiguousarray(col.values)
+        digest.update(repr((col.ctype, sorted(col.meta.items()), values.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(col.seconds).tobytes())
+        digest.update(values.tobytes())
+    return digest.digest()
+
+
+def activity_fingerprint(activity):
+    """A digest of an activity frame (see activity_frame)."""
+    frame, start = activity
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((str(frame.index.tz), list(frame.columns), start)).encode())
+    digest.update(codec.epoch_seconds(frame.index).tobytes())
+    digest.update(np.ascontiguousarray(frame.values, dtype="float64").tobytes())
+    return digest.digest()
+
+
+class FrameCache:
+    """FrameCache memoizes the results of each stage of make_frame. A
+    stage's result is keyed by the key of its input (ultimately, a
+    fingerprint of the request) and the values of the hyper
+    parameters that it reads, so that changing a hyper parameter
+    recomputes only the stages from the one that reads it onwards.
+    The cache holds at most maxbytes of frames (see frame_nbytes),
+    evicting the least recently used; larger results are not cached.
+    It keeps hit, miss, and (computation) time statistics for each
+    stage, and is safe for concurrent use. Cached results are shared
+    among all callers, and must not be modified."""
+
+    def __init__(self, maxbytes=256 * 2**20):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        # Results, and their sizes, by key.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(
+            lambda: {"hits": 0, "misses": 0, "time": 0.0})
+
+    def get(self, stage, input_key, input, hyper_params):
+        """Return the key and result of the stage applied to input,
+        whose key is input_key."""
+        if callable(stage.hyper_params):
+            values = stage.hyper_params(hyper_params)
+        else:
+            values = tuple(hyper_params.get(name) for name in stage.hyper_params)
+        key = (input_key, stage.name) + tuple(repr(value) for value in values)
+        with self._lock:
+            stats = self._stats[stage.name]
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                stats["hits"] += 1
+                return key, self._entries[key][0]
+            stats["misses"] += 1
+
+        start = time.perf_counter()
+        result = stage.fn(input, hyper_params)
+        elapsed = time.perf_counter() - start
+        nbytes = frame_nbytes(result)
+
+        with self._lock:
+            stats["time"] += elapsed
+            if nbytes <= self.maxbytes and key not in self._entries:
+                self._entries[key] = result, nbytes
+                self.nbytes += nbytes
+                while self.nbytes > self.maxbytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted
+        return key, result
+
+    def stats(self):
+        """Hits, misses, and total computation time (in seconds) by stage."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def frame_nbytes(result):
+    """The memory used by the result of a frame stage: a frame, or an
+    activity (frame, start) pair."""
+    frame = result[0] if isinstance(result, tuple) else result
+    return int(frame.memory_usage(index=True).sum())
+
+
+# The cache of make_frame. Since it is bounded by size, a server that
+# fits many users' requests holds only the most recent of their frames.
+frame_cache = FrameCache()
+
+
+def cached_activity_frame(request, hyper_params=default_hyper_params):
+    """The result of the (cached) activity stage of make_frame."""
+    _, activity = frame_cache.get(
+        frame_stages[0], request_fingerprint(request), request, hyper_params)
+    return activity
+
+
+def make_frame(request, hyper_params=default_hyper_params, activity=None):
+    """Build the training frame for the request by running each of
+    frame_stages, whose results are cached in frame_cache. The result
+    of activity_frame may be provided as activity, in which case it is
+    used in place of the activity stage."""
+    if activity is None:
+        key, activity = frame_cache.get(
+            frame_stages[0], request_fingerprint(request), request, hyper_params)
+    else:
+        key = activity_fingerprint(activity)
+    result = activity
+    for stage in frame_stages[1:]:
+        key, result = frame_cache.get(stage, key, result, hyper_params)
+    # The cached frame is shared; callers may modify their own copy.
+    return result.copy()
+
+
 # TODO: don't force schedules to have a parameter at index 0.
 def pack_params(indexed_params, nperiod=288):
     [indices, params] = list(zip(*indexed_params))
@@ -291,6 +713,48 @@ def index_to_intervals(index, nperiod=288):
     return intervals
 
 
+def design_matrix(curve, index, nperiod=288):
+    """The [nperiod, len(index)] matrix X that maps parameters over
+    the windows of index to the total curve activity in each period:
+    entry [i, w] sums curve[(j-i) % nperiod] over the periods j in
+    window w. The returned matrix is cached, and read-only."""
+    return window_sums(curve, index, nperiod, lag=False)
+
+
+def window_sums(curve, index, nperiod=288, lag=True):
+    """The [nperiod, len(index)] matrix whose entry [i, w] sums
+    curve[(i-j) % nperiod] (or curve[(j-i) % nperiod] if not lag) over
+    the periods j in window w of the schedule index.
+
+    Each entry is a sum over a contiguous (cyclic) range of the curve,
+    and is computed as the difference of two prefix sums, so that
+    matrices take O(nperiod * len(index)) time to build. Matrices
+    depend only on the curve and the schedule, so they are cached;
+    the returned matrix is read-only."""
+    return _window_sums(
+        np.ascontiguousarray(curve, dtype="float64").tobytes(),
+        tuple(int(i) for i in index), nperiod, lag)
+
+
+@functools.lru_cache(maxsize=256)
+def _window_sums(curve, index, nperiod, lag):
+    curve = np.frombuffer(curve, dtype="float64")
+    # Prefix sums over two cycles of the curve, so that any cyclic
+    # range of up to nperiod entries is a difference of two of them.
+    prefix = np.concatenate([[0.0], np.cumsum(np.tile(curve, 2))])
+    periods = np.arange(nperiod)
+    X = np.zeros([nperiod, len(index)])
+    for w, ivs in enumerate(index_to_intervals(index, nperiod=nperiod)):
+        for beg, end in ivs:
+            if lag:
+                first = (periods - (end - 1)) % nperiod
+            else:
+                first = (beg - periods) % nperiod
+            X[:, w] += prefix[first + (end - beg)] - prefix[first]
+    X.flags.writeable = False
+    return X
+
+
 def identify_curve(curve, index, target, nperiod=288):
     """Identity nperiod non-negative parameters that optimize the target
     applied to curves."""
@@ -298,47 +762,173 @@ def identify_curve(curve, index, target, nperiod=288):
     assert target.shape == (nperiod,), f"bad target shape {target.shape}"
     assert np.shape(index)[0] <= nperiod, f"bad index shape {index.shape}"
 
-    # First, create a [nperiod, nperiod] matrix X that computes the
-    # curve for each period. We then reduce this to a [nperiod,
-    # len(index)] matrix that sums contributions over each each
-    # window (i.e., groups of columns) defined by the provided index.
-
-    roll = np.zeros([nperiod, nperiod], dtype=int)
-    curve_index = np.arange(nperiod)
-    for i in range(roll.shape[0]):
-        # Shape the curve at period i.
-        roll[i, :] = np.roll(curve_index, i)
-
-    X_rolled = curve[roll]
-    X = np.zeros([nperiod, len(index)])
-    for i, ivs in enumerate(index_to_intervals(index, nperiod=nperiod)):
-        for beg, end in ivs:
-            X[:, i] += np.sum(X_rolled[:, beg:end], axis=1)
-
+    X = design_matrix(curve, index, nperiod=nperiod)
     y = target
     x, rnorm = optimize.nnls(X, y)
     return x
 
 
 def attribute_parameters(curve, index, values, nparam=24, nperiod=288):
+    """Attribute the schedule (index, values) to nparam instantaneous
+    parameters: the schedule's values are applied to the curve (as
+    seen from each period), and averaged over each parameter's
+    periods."""
     assert curve.shape == (nperiod,), f"bad curve shape {curve.shape}"
 
-    roll = np.zeros([nperiod, nperiod], dtype=int)
-    curve_index = np.flip(np.arange(nperiod))
-    for i in range(roll.shape[0]):
-        # Shape the curve at period i.
-        roll[i, :] = np.roll(curve_index, i+1)
-    X = curve[roll]
-
-    for i, ivs in enumerate(index_to_intervals(index, nperiod=nperiod)):
-        for beg, end in ivs:
-            X[:, beg:end] *= values[i]  # np.sum(X_rolled[:, beg:end], axis=1)
-    x = np.sum(X, axis=1)
+    x = window_sums(curve, index, nperiod=nperiod) @ np.asarray(values, dtype="float64")
     x = np.mean(np.reshape(x, (nparam, nperiod//nparam)), axis=1)
     return x
 
 
-def fit(request, hyper_params=default_hyper_params, nperiod=288):
+def quantile_linprog(X, y, weights, quantile, bounds):
+    """Solve the weighted quantile regression
+
+        minimize mean(pinball(weights * (y - X theta)))
+
+    subject to bounds (a [p, 2] array) on theta exactly, as a sparse
+    linear program. Residuals are split into nonnegative parts
+    r+ - r- = y - X theta, whose weighted sum is minimized."""
+    n, p = X.shape
+    eye = sparse.identity(n, format="csr")
+    A_eq = sparse.hstack([X, eye, -eye], format="csr")
+    c = np.concatenate([
+        np.zeros(p), quantile * weights / n, (1.0 - quantile) * weights / n])
+    residual_bounds = np.tile([0.0, math.inf], (2 * n, 1))
+    res = optimize.linprog(
+        c, A_eq=A_eq, b_eq=y, bounds=np.vstack([bounds, residual_bounds]),
+        method="highs")
+    if res.status != 0:
+        raise Exception(f"linprog failed: {res.message}")
+    return res.x[:p], res
+
+
+def pinned_bounds(X, values, lower, upper):
+    """Bounds for the columns of X that pin the columns that have no
+    data (and are thus not identified) at their current values."""
+    free = np.asarray(abs(X).sum(axis=0)).ravel() > 0
+    return np.column_stack([
+        np.where(free, lower, values), np.where(free, upper, values)])
+
+
+def minimize_linprog(carbs, insulin, deltas, hour, weights, quantile,
+                     init_params, lower, upper, iterations=10, tol=1e-6,
+                     max_carb_ratio=1000.0):
+    """Fit the model
+
+        delta = isf[hour] * (carbs / carb_ratio[hour] - insulin + basal[hour])
+
+    under the quantile loss, with parameters bounded by lower and
+    upper. The model is bilinear, so we alternate between two exact
+    LPs: with insulin sensitivities fixed, it is linear in the basals
+    and the inverse carb ratios; with those fixed, it is linear in the
+    insulin sensitivities. Alternation stops after the given number of
+    iterations, or once the loss improves by less than tol (relative).
+
+    Returns the parameters (ordered as in fit) and solver statistics."""
+    n = len(deltas)
+    rows = np.arange(n)
+    basals, isfs, carb_ratios = (
+        init_params[:24], init_params[24:48], init_params[48:72])
+
+    # Bounds on carb ratios are bounds on their inverses; these are
+    # kept positive so that carb ratios remain finite.
+    with np.errstate(divide="ignore"):
+        inverse_lower = np.maximum(1.0 / upper[48:72], 1.0 / max_carb_ratio)
+        inverse_upper = 1.0 / lower[48:72]
+    lower = np.concatenate([lower[:24], inverse_lower, lower[24:48]])
+    upper = np.concatenate([upper[:24], inverse_upper, upper[24:48]])
+
+    stats = {"iterations": 0, "solver_iterations": 0, "solve_time": 0.0}
+    previous = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+
+        isf = isfs[hour]
+        X = sparse.csr_matrix(
+            (np.concatenate([isf, isf * carbs]),
+             (np.concatenate([rows, rows]), np.concatenate([hour, 24 + hour]))),
+            shape=(n, 48))
+        current = np.concatenate([basals, 1.0 / carb_ratios])
+        theta, res = quantile_linprog(
+            X, deltas + isf * insulin, weights, quantile,
+            pinned_bounds(X, current, lower[:48], upper[:48]))
+        basals, carb_ratios = theta[:24], 1.0 / theta[24:]
+        stats["solver_iterations"] += res.nit
+
+        activity = carbs / carb_ratios[hour] - insulin + basals[hour]
+        X = sparse.csr_matrix((activity, (rows, hour)), shape=(n, 24))
+        isfs, res = quantile_linprog(
+            X, deltas, weights, quantile,
+            pinned_bounds(X, isfs, lower[48:], upper[48:]))
+        stats["solver_iterations"] += res.nit
+
+        stats["solve_time"] += time.perf_counter() - start
+        stats["iterations"] += 1
+        if previous is not None and previous - res.fun <= tol * abs(previous):
+            break
+        previous = res.fun
+
+    return np.concatenate([basals, isfs, carb_ratios]), stats
+
+
+def hourly_moments(hour, weights, deltas, carbs, insulin, nhour=24):
+    """Gather the sufficient statistics of the squared loss: for each
+    hour h, the [4, 4] matrix of weighted second moments of
+    z = (delta, carbs, insulin, 1) over the rows in that hour.
+
+    The weighted residual of a row is w * (theta_h . z), where
+    theta_h = (1, -isf_h / carb_ratio_h, isf_h, -isf_h * basal_h), so
+    its squared sum over an hour is theta_h^T M_h theta_h."""
+    z = weights[:, None] * np.column_stack(
+        [deltas, carbs, insulin, np.ones_like(deltas)])
+    moments = np.empty((nhour, 4, 4))
+    for j in range(4):
+        for k in range(j, 4):
+            moments[:, j, k] = moments[:, k, j] = np.bincount(
+                hour, weights=z[:, j] * z[:, k], minlength=nhour)
+    return moments
+
+
+def squared_loss(moments, n, basals, insulin_sensitivities, carb_ratios):
+    """The mean squared weighted residual of the model, computed from
+    hourly_moments in time independent of the number of rows n."""
+    theta = np.stack([
+        np.ones_like(basals),
+        -insulin_sensitivities / carb_ratios,
+        insulin_sensitivities,
+        -insulin_sensitivities * basals,
+    ], axis=1)
+    return np.sum(theta[:, :, None] * moments * theta[:, None, :]) / n
+
+
+def pinball_loss(error, quantile, smoothing=0.0):
+    """The pinball (quantile) loss of each error."""
+    if smoothing > 0:
+        # A smoothed pinball loss, which approaches
+        # max(q*e, (q-1)*e) as the smoothing goes to 0.
+        return quantile * error + smoothing * np.logaddexp(0.0, -error / smoothing)
+    return np.maximum(quantile * error, (quantile - 1.0) * error)
+
+
+def predict(frame, basals, insulin_sensitivities, carb_ratios):
+    """The glucose deltas predicted for the rows of a training frame
+    (see make_frame) by hourly parameters, as fitted by fit (raw_basals,
+    etc.)."""
+    hour = np.asarray(frame.index.hour)
+    return insulin_sensitivities[hour] * (
+        frame["carb"].values / carb_ratios[hour] - frame["insulin"].values + basals[hour])
+
+
+def fit(request, hyper_params=default_hyper_params, nperiod=288, activity=None,
+        sample_weights=None):
+    """Fit a model to the request. The activity frame (see
+    activity_frame) may be provided, to avoid recomputing it.
+
+    Rows of the training frame may be weighted by sample_weights, a
+    series indexed by time (rows missing from it get weight 0); each
+    row's contribution to the loss is scaled by its weight. This is
+    used to fit bootstrap resamples (see bootstrap.py) without
+    materializing them."""
     passed_hyper_params = hyper_params
     hyper_params = {}
     hyper_params.update(passed_hyper_params)
@@ -346,16 +936,23 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
 
     logging.info(f"fitting model with hyper parameters {hyper_params}")
 
-    frame = make_frame(request, hyper_params=hyper_params)
-
-    basal_insulin_curve = expia1(
-        np.arange(nperiod),
-        request.basal_insulin_parameters.get("delay", 5.0) / 5.0,
-        request.basal_insulin_parameters["peak"] / 5.0,
-        request.basal_insulin_parameters["duration"] / 5.0,
+    start = time.perf_counter()
+    if activity is None:
+        activity = cached_activity_frame(request, hyper_params)
+    frame = make_frame(request, hyper_params=hyper_params, activity=activity)
+    frame_time = time.perf_counter() - start
+
+    basal_insulin_curve = curve_coeffs(
+        "insulin",
+        (
+            request.basal_insulin_parameters.get("delay", 5.0),
+            request.basal_insulin_parameters["peak"],
+            request.basal_insulin_parameters["duration"],
+        ),
+        horizon=nperiod,
     )
     # TODO: make this the average carb curve
-    default_carb_curve = carb_curve(np.arange(nperiod), 3, 36)
+    default_carb_curve = curve_coeffs("carb", (15, 180), horizon=nperiod)
 
     # Set up parameter schedules.
     #
@@ -370,7 +967,7 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     if request.insulin_sensitivity_schedule is not None:
         init_insulin_sensitivity_params = attribute_parameters(
             basal_insulin_curve,
-            request.insulin_sensitivity_schedule.index,
+            request.insulin_sensitivity_schedule.reindexed(5),
             request.insulin_sensitivity_schedule.values)
     else:
         init_insulin_sensitivity_params = 140*np.ones(24)
@@ -378,7 +975,7 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     if request.carb_ratio_schedule is not None:
         init_carb_ratio_params = attribute_parameters(
             default_carb_curve,
-            request.carb_ratio_schedule.index,
+            request.carb_ratio_schedule.reindexed(5),
             request.carb_ratio_schedule.values)
     else:
         init_carb_ratio_params = 15.*np.ones(24)
@@ -389,7 +986,7 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
             request.basal_rate_schedule.values)
         init_basal_rate_params = attribute_parameters(
             basal_insulin_curve,
-            request.basal_rate_schedule.index,
+            request.basal_rate_schedule.reindexed(5),
             request.basal_rate_schedule.values)
     else:
         init_basal_rate_params = np.zeros(24)
@@ -402,17 +999,39 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     def unpack_params(params):
         return params[:24], params[24:48], params[48:72]
 
+    # Only the schedules in request.tune_parameters (by default, all
+    # of them) are optimized; the others are pinned to their initial
+    # values, and dropped from the optimization problem.
+    unknown = set(request.tune_parameters or ()) - set(schedule_names)
+    if unknown:
+        raise Exception(f"unknown tune_parameters {sorted(unknown)}")
+    tuned = [
+        name for name in schedule_names
+        if request.tune_parameters is None or name in request.tune_parameters
+    ]
+    free = np.repeat([name in tuned for name in schedule_names], 24)
+
+    def expand(x):
+        """The full parameter vector, given the tuned parameters x."""
+        blocks, k = [], 0
+        for name, block in zip(schedule_names, unpack_params(init_params)):
+            if name in tuned:
+                block, k = x[k:k + 24], k + 24
+            blocks.append(block)
+        return np.concatenate(blocks)
+
     insulin = frame["insulin"].values
     carbs = frame["carb"].values
     deltas = frame["delta"].values
 
-    hour = frame.index.hour
+    hour = np.asarray(frame.index.hour)
     quantile = hyper_params["quantile_loss_quantile"]
+    smoothing = hyper_params.get("quantile_loss_smoothing", 0.0)
 
     # Construct bounds based on the allowable tuning limit.
     if request.tuning_limit is not None and request.tuning_limit > 0:
         bounds = list(zip(init_params*(1-request.tuning_limit),
-                          init_params*1+request.tuning_limit))
+                          init_params*(1+request.tuning_limit)))
     else:
         bounds = None
 
@@ -423,13 +1042,29 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     weights[frame["carb"] > 0] = (
         np.sum(frame["carb"] == 0) / np.sum(frame["carb"] > 0)
     )
-
-    def model(params):
+    if sample_weights is not None:
+        sample_weights = sample_weights.reindex(frame.index, fill_value=0.0).values
+        # The squared loss squares the weights (see hourly_moments).
+        if hyper_params.get("loss", "quantile") == "squared":
+            sample_weights = np.sqrt(sample_weights)
+        weights = weights * sample_weights.astype(weights.dtype)
+
+    # The model is evaluated in the frame's precision; losses are
+    # accumulated in float64 (see make_objective). Parameters are cast
+    # after they are gathered, so that their gradients are scattered
+    # back in float64.
+    dtype = deltas.dtype
+
+    def gather(values, rows):
+        values = values[hour[rows]]
+        return values if values.dtype == dtype else values.astype(dtype)
+
+    def model(params, rows=slice(None)):
         basals, insulin_sensitivities, carb_ratios = unpack_params(params)
-        basal = basals[hour]
-        insulin_sensitivity = insulin_sensitivities[hour]
-        carb_ratio = carb_ratios[hour]
-        return insulin_sensitivity * (carbs / carb_ratio - insulin + basal)
+        basal = gather(basals, rows)
+        insulin_sensitivity = gather(insulin_sensitivities, rows)
+        carb_ratio = gather(carb_ratios, rows)
+        return insulin_sensitivity * (carbs[rows] / carb_ratio - insulin[rows] + basal)
 
     if bounds is not None:
         lower, upper = zip(*bounds)
@@ -440,9 +1075,48 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
         insulin_duration_hours = request.basal_insulin_parameters["duration"] / 60.
         lower[:24] = lower[:24]/insulin_duration_hours
         upper[:24] = upper[:24]/insulin_duration_hours
+        # Parameters without an initial value (e.g., basals when no
+        # schedule is provided) would have empty bounds; leave them
+        # unbounded above instead.
+        upper = np.where(upper > lower, upper, math.inf)
+
+    def pinball(error):
+        return pinball_loss(error, quantile, smoothing)
+
+    # The loss is written so that autograd can differentiate it:
+    # no in-place updates of params.
+    nloss = 0
+
+    def make_objective(rows):
+        """The (unpenalized) loss over the given rows of the frame."""
+        if hyper_params.get("loss", "quantile") == "squared":
+            moments = hourly_moments(
+                hour[rows], weights[rows], deltas[rows], carbs[rows], insulin[rows])
+            n = len(deltas[rows])
+            return lambda params: squared_loss(moments, n, *unpack_params(params))
+        elif hyper_params.get("loss", "quantile") == "quantile":
+            def objective(params):
+                # Quantile regression: 50 pctile
+                error = weights[rows] * (deltas[rows] - model(params, rows))
+                return np.mean(pinball(error), dtype="float64")
+            return objective
+        else:
+            raise Exception(f"unknown loss {hyper_params['loss']}")
+
+    objective = make_objective(slice(None))
+
+    # Hold out the most recent data for early stopping.
+    holdout = hyper_params.get("holdout_fraction", 0.0)
+    if holdout > 0 and hyper_params["optimizer"] == "adam":
+        split = int(len(deltas) * (1.0 - holdout))
+        fit_objective = make_objective(slice(None, split))
+        holdout_objective = make_objective(slice(split, None))
+    else:
+        fit_objective, holdout_objective = objective, None
 
     def loss(params, iter):
-        preds = model(params)
+        nonlocal nloss
+        nloss += 1
         penalty = -10.0 * np.sum(np.minimum(params, 0.0))
 
         # Use a barrier function if bounds are provided.
@@ -451,26 +1125,73 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
             # Note also that this doesn't work for basals since they
             # are summed up.
             epsilon = 0.00001
-            penalty_params = params.copy()
-            penalty_params[penalty_params >=
-                           upper] = upper[penalty_params > upper]-epsilon
-            penalty_params[penalty_params <=
-                           lower] = lower[penalty_params <= lower]+epsilon
+            penalty_params = np.minimum(
+                np.maximum(params, lower + epsilon), upper - epsilon)
             penalty += np.sum(np.maximum(0., -0.01 *
                                          np.log(upper-penalty_params)))
             penalty += np.sum(np.maximum(0., -0.01 *
                                          np.log(penalty_params-lower)))
 
-        # Quantile regression: 50 pctile
-        error = weights * (deltas - preds)
-        return np.mean(np.maximum(quantile * error, (quantile - 1.0) * error)) + penalty
-
-    if hyper_params["optimizer"] == "adam":
-        params, training_loss = train.minimize(loss, init_params)
+        return fit_objective(params) + penalty
+
+    def tuned_loss(x, iter):
+        return loss(expand(x), iter)
+
+    def tuned_holdout_loss(x):
+        return holdout_objective(expand(x))
+
+    stats = {
+        "optimizer": hyper_params["optimizer"],
+        "parameters": int(np.sum(free)),
+        "frame_time": frame_time,
+    }
+    start = time.perf_counter()
+    if not tuned:
+        params = init_params
+        training_loss = float(loss(params, 0))
+        stats["iterations"] = 0
+    elif hyper_params["optimizer"] == "adam":
+        x, training_loss, iterations = train.minimize(
+            tuned_loss, init_params[free],
+            holdout_loss=None if holdout_objective is None else tuned_holdout_loss)
+        params = expand(x)
+        training_loss = float(training_loss)
+        stats["iterations"] = iterations
     elif hyper_params["optimizer"] == "scipy.minimize":
-        opt = optimize.minimize(loss, init_params, args=(0,))
-        params = opt.x
-        training_loss = opt.fun
+        if hyper_params.get("gradient", "autograd") == "autograd":
+            tuned_loss_and_grad = value_and_grad(tuned_loss)
+
+            def fun(x, iter):
+                # The optimizer works in float64 regardless of the
+                # frame's precision.
+                value, gradient = tuned_loss_and_grad(x, iter)
+                return float(value), np.asarray(gradient, dtype="float64")
+            opt = optimize.minimize(fun, init_params[free], args=(0,), jac=True)
+        else:
+            # E.g., "2-point" for finite differences.
+            opt = optimize.minimize(
+                tuned_loss, init_params[free], args=(0,), jac=hyper_params["gradient"])
+        params = expand(opt.x)
+        training_loss = float(opt.fun)
+        stats["iterations"] = int(opt.nit)
+    elif hyper_params["optimizer"] == "linprog":
+        if hyper_params.get("loss", "quantile") != "quantile":
+            raise Exception("the linprog optimizer requires the quantile loss")
+        if bounds is None:
+            lower, upper = np.zeros(72), np.full(72, math.inf)
+        # Pinned parameters are eliminated by the LP solver's presolve.
+        lower = np.where(free, lower, init_params)
+        upper = np.where(free, upper, init_params)
+        params, linprog_stats = minimize_linprog(
+            carbs, insulin, deltas, hour, weights, quantile, init_params,
+            lower, upper, iterations=hyper_params.get("linprog_iterations", 10))
+        training_loss = float(objective(params))
+        stats.update(linprog_stats)
+    else:
+        raise Exception(f"unknown optimizer {hyper_params['optimizer']}")
+    stats["loss_evaluations"] = nloss
+    stats["time"] = time.perf_counter() - start
+    logging.info(f"optimizer stats {stats}")
 
     # Clip the parameters here in case the loss penalties
     # above were insufficient.
@@ -482,33 +1203,26 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     # carb curve based on data. We also use the basal insulin
     # parameters for ISF schedules.
 
-    if request.basal_rate_schedule is None:
-        # Default: hourly
-        basal_rate_index = np.arange(0, 288, 12)
-    else:
-        basal_rate_index = request.basal_rate_schedule.reindexed(5)
-    basal_rate_schedule = (
-        identify_curve(basal_insulin_curve, basal_rate_index,
-                       np.repeat(basals, 12)) * 12
-    )
+    def identify_schedule(name, curve, default_index, values, scale=1.0):
+        schedule = getattr(request, name)
+        if name not in tuned and schedule is not None:
+            # Untuned schedules are returned as given.
+            return schedule.reindexed(5), np.array(schedule.values, dtype="float64")
+        index = default_index if schedule is None else schedule.reindexed(5)
+        return index, identify_curve(curve, index, np.repeat(values, 12)) * scale
 
-    if request.insulin_sensitivity_schedule is None:
-        insulin_sensitivity_index = np.arange(0, 288, 12 * 4)
-    else:
-        insulin_sensitivity_index = request.insulin_sensitivity_schedule.reindexed(
-            5)
-    insulin_sensitivity_schedule = identify_curve(
-        basal_insulin_curve, insulin_sensitivity_index, np.repeat(
-            insulin_sensitivities, 12)
-    )
+    # Default: hourly
+    basal_rate_index, basal_rate_schedule = identify_schedule(
+        "basal_rate_schedule", basal_insulin_curve, np.arange(0, 288, 12),
+        basals, scale=12)
 
-    if request.carb_ratio_schedule is None:
-        carb_ratio_index = 12 * 6 + np.arange(0, 12 * 12, 4 * 12)
-    else:
-        carb_ratio_index = request.carb_ratio_schedule.reindexed(5)
-    carb_ratio_schedule = identify_curve(
-        default_carb_curve, carb_ratio_index, np.repeat(carb_ratios, 12)
-    )
+    insulin_sensitivity_index, insulin_sensitivity_schedule = identify_schedule(
+        "insulin_sensitivity_schedule", basal_insulin_curve,
+        np.arange(0, 288, 12 * 4), insulin_sensitivities)
+
+    carb_ratio_index, carb_ratio_schedule = identify_schedule(
+        "carb_ratio_schedule", default_carb_curve,
+        12 * 6 + np.arange(0, 12 * 12, 4 * 12), carb_ratios)
 
     # Finally, "quantize" the basal schedule if needed.
     #
@@ -525,7 +1239,7 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
     # parameters accordingly.
     #
     # TODO: collapse adjacent entries with the same value.
-    if request.allowed_basal_rates is not None:
+    if request.allowed_basal_rates is not None and "basal_rate_schedule" in tuned:
         allowed = sorted(request.allowed_basal_rates)
         for (i, rate) in enumerate(basal_rate_schedule):
             j = bisect.bisect(allowed, rate)
@@ -554,6 +1268,8 @@ def fit(request, hyper_params=default_hyper_params, nperiod=288):
         raw_carb_ratios=carb_ratios,
         raw_basals=basals,
         training_loss=training_loss,
+        tuned_parameters=tuned,
+        stats=stats,
     )
 
 
@@ -569,11 +1285,12 @@ def main():
 
     args = parser.parse_args()
 
-    input = open(args.file)
-    if input is None:
-        input = sys.stdin
-    payload = json.load(input)
-    request = codec.Request.fromdict(payload)
+    if args.file is None:
+        body = sys.stdin.buffer.read()
+    else:
+        with open(args.file, "rb") as input:
+            body = input.read()
+    request = codec.decode_request(body, frame_warmup)
     hyper_params = {}
     hyper_params.update(default_hyper_params)
     for key in hyper_params:
@@ -582,6 +1299,11 @@ def main():
             hyper_params[key] = flag_value
 
     model = fit(request, hyper_params=hyper_params)
+    confidence_intervals = None
+    if hyper_params["bootstrap_replicates"] > 0:
+        # Imported here since bootstrap imports this module.
+        import bootstrap
+        confidence_intervals, _ = bootstrap.intervals(request, hyper_params)
 
     resp = codec.Response(
         version=1,
@@ -596,6 +1318,8 @@ def main():
             model.params["basal_rate_schedule"]
         ),
         training_loss=model.training_loss,
+        tuned_parameters=model.tuned_parameters,
+        confidence_intervals=confidence_intervals,
     )
     output = json.dumps(resp.todict())
     if args.output is None:
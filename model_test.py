@@ -58,6 +58,27 @@ class TestResample(unittest.TestCase):
             else:
                 self.fail(f"invalid column type {col.ctype}")
 
+    def test_resample_grid(self):
+        index = pd.DatetimeIndex(
+            [
+                "2019-12-18 20:56:00+00:00",
+                "2019-12-18 20:46:30+00:00",
+                "2019-12-18 20:47:00+00:00",
+            ],
+            dtype="datetime64[ns, UTC]",
+        )
+        timeseries = [
+            codec.Timeseries("glucose", {}, pd.Series([1, 2, 3], index)),
+            codec.Timeseries("carb", {}, pd.Series([1, 2, 3], index)),
+        ]
+        seconds, (glucose, carb) = model.resample_grid(
+            codec.Request("UTC", timeseries))
+
+        np.testing.assert_array_equal(
+            seconds, [1576701900, 1576702200, 1576702500])
+        np.testing.assert_array_equal(glucose, [2, math.nan, 1])
+        np.testing.assert_array_equal(carb, [5, 0, 1])
+
 
 class CurveTest:
     def ctype(self):
@@ -153,6 +174,81 @@ class TestCarbCurves(unittest.TestCase, CurveTest):
         return model.apply_carb_curve(column)
 
 
+class ConvolveTest(unittest.TestCase):
+    def rolling(self, values, coeffs):
+        return (
+            pd.Series(values)
+            .rolling(window=len(coeffs))
+            .apply(lambda x: np.dot(x, np.flip(coeffs, 0)), raw=True)
+            .values
+        )
+
+    def test_matches_rolling(self):
+        rng = np.random.RandomState(0)
+        values = rng.uniform(size=2000)
+        values[500] = math.nan
+        values[1200:1210] = math.nan
+        for window in [model.Whoriz, model.fft_min_window + 10]:
+            coeffs = rng.uniform(size=window)
+            expected = self.rolling(values, coeffs)
+            actual = model.convolve(values, coeffs)
+            np.testing.assert_array_equal(np.isnan(expected), np.isnan(actual))
+            np.testing.assert_allclose(expected, actual, rtol=1e-9)
+
+    def test_rows(self):
+        rng = np.random.RandomState(0)
+        for window in [model.Whoriz, model.fft_min_window]:
+            values = rng.uniform(size=(3, 1000))
+            coeffs = rng.uniform(size=(3, window))
+            actual = model.convolve(values, coeffs)
+            for i in range(3):
+                np.testing.assert_allclose(
+                    actual[i], model.convolve(values[i], coeffs[i]), rtol=1e-9)
+
+    def test_fft_zeros(self):
+        values = np.zeros(2000)
+        values[1000] = 1.0
+        coeffs = np.zeros(model.fft_min_window)
+        coeffs[10:20] = 1.0
+        out = model.convolve(values, coeffs)
+        self.assertEqual(np.sum(out > 0), 10)
+
+
+class CurveCacheTest(unittest.TestCase):
+    def test_cache(self):
+        cache = model.CurveCache(maxsize=2)
+        coeffs = cache.get("insulin", (10, 30, 120))
+        np.testing.assert_array_equal(
+            coeffs, model.expia1(model.Wtime, 2.0, 6.0, 24.0))
+        self.assertFalse(coeffs.flags.writeable)
+        self.assertIs(cache.get("insulin", (10, 30, 120)), coeffs)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.get("carb", (15, 60))
+        cache.get("carb", (15, 60), horizon=288)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(cache.get("insulin", (10, 30, 120)), coeffs)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+
+class CarbCurveMatrixTest(unittest.TestCase):
+    def test_matrix(self):
+        t = np.arange(288)
+        delays = np.array([2.0, 3.0, 3.0])
+        durations = np.array([6.0, 12.0, 36.0])
+        for curve in [model.dm61_nonlinear, model.walshca]:
+            matrix = curve(t, delays, durations)
+            self.assertEqual(matrix.shape, (3, 288))
+            for i in range(3):
+                np.testing.assert_array_equal(
+                    matrix[i], curve(t, delays[i], durations[i]))
+
+        np.testing.assert_allclose(
+            np.sum(model.dm61_nonlinear(t, delays, durations), axis=1), 1.0)
+        np.testing.assert_array_equal(
+            model.dm61_nonlinear(t, delays, durations)[:, :2], 0.0)
+
+
 def make_test_frame():
     index = pd.date_range("12/1/2019", periods=12 * 24, freq=model.Period)
     zeros = np.zeros_like(index, dtype=np.float64)
@@ -202,12 +298,313 @@ class FrameTest(unittest.TestCase):
         self.assertEqual(frame["glucose"].sum(), 28825)
         self.assertAlmostEqual(frame["carb"].sum(), 134, 1)
 
+    def test_shared_curves(self):
+        frame = model.resample(make_test_frame())
+        shared = frame.timeseries[2]
+        frame.timeseries.append(
+            codec.Timeseries.fromarrays(
+                "bolus", dict(shared.meta), shared.seconds, shared.values * 2, frame.timezone))
+
+        insulin = sum(
+            model.apply_insulin_curve(col) / 1000.0
+            for col in frame.timeseries if col.ctype in ["insulin", "bolus"])
+        actual = model.make_pandas_frame(frame)["insulin"]
+        np.testing.assert_allclose(actual.values, insulin.values, rtol=1e-12)
+
+
+    def test_frame_cache(self):
+        model.frame_cache.clear()
+        request = make_test_frame()
+        frame = model.make_frame(request)
+        frame["delta"] = 12345.0
+        rolled = model.make_frame(
+            request, dict(model.default_hyper_params, rolling_window=4))
+
+        stats = model.frame_cache.stats()
+        self.assertEqual(stats["activity"], dict(stats["activity"], hits=1, misses=1))
+        self.assertEqual(stats["delta"], dict(stats["delta"], hits=1, misses=1))
+        self.assertEqual(stats["rolling"], dict(stats["rolling"], hits=0, misses=2))
+        self.assertGreater(stats["activity"]["time"], 0.0)
+
+        # Cached frames are not affected by modifications to returned ones.
+        pd.testing.assert_frame_equal(
+            model.make_frame(request), model.make_frame(make_test_frame()))
+        self.assertFalse((model.make_frame(request)["delta"] == 12345.0).any())
+
+        expected = model.make_frame(
+            request, dict(model.default_hyper_params, rolling_window=4),
+            activity=model.activity_frame(request))
+        pd.testing.assert_frame_equal(rolled, expected)
+
+    def test_frame_cache_bytes(self):
+        request = make_test_frame()
+        activity = model.activity_frame(request)
+        nbytes = model.frame_nbytes(activity)
+        cache = model.FrameCache(maxbytes=2 * nbytes)
+        for rolling_window in [2, 4, 8]:
+            cache.get(
+                model.frame_stages[2], "key", activity,
+                dict(model.default_hyper_params, rolling_window=rolling_window))
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, cache.maxbytes)
+
+        # Results larger than the cache are not cached.
+        cache = model.FrameCache(maxbytes=nbytes - 1)
+        cache.get(model.frame_stages[0], "key", request, model.default_hyper_params)
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_frame_limit(self):
+        rng = np.random.RandomState(0)
+        seconds = 1575158400 + 300 * np.arange(3 * 288)
+        deliveries = np.where(rng.uniform(size=len(seconds)) < 0.1, 1000.0, 0.0)
+        request = codec.Request(
+            timezone="UTC",
+            timeseries=[
+                codec.Timeseries.fromarrays(
+                    "glucose", {}, seconds, 100 + np.cumsum(rng.normal(size=len(seconds))), "UTC"),
+                codec.Timeseries.fromarrays(
+                    "insulin", {"delay": 5, "peak": 65, "duration": 205}, seconds, deliveries, "UTC"),
+                codec.Timeseries.fromarrays(
+                    "carb", {"delay": 15, "duration": 120}, seconds, deliveries / 100, "UTC"),
+            ],
+        )
+        unlimited = model.make_frame(request)
+        limited = model.make_frame(
+            request, dict(model.default_hyper_params, frame_limit=1.0))
+
+        start = pd.Timestamp(seconds[-1] - 24 * 60 * 60, unit="s", tz="UTC")
+        self.assertEqual(limited.index[0], start)
+        pd.testing.assert_frame_equal(limited, unlimited[unlimited.index >= start])
+
+    def test_frame_limit_warmup(self):
+        # The warm-up covers windows longer than the activity horizon's
+        # slack, so the limited frame is still the tail of the full one.
+        request = make_days_request(3)
+        hyper_params = dict(model.default_hyper_params, rolling_window=24, delta_window=12)
+        unlimited = model.make_frame(request, hyper_params)
+        limited = model.make_frame(request, dict(hyper_params, frame_limit=1.0))
+        self.assertEqual(len(limited), 289)
+        pd.testing.assert_frame_equal(limited, unlimited[-len(limited):])
+
+
+def make_days_request(days, seed=0):
+    rng = np.random.RandomState(seed)
+    seconds = 1575158400 + 300 * np.arange(days * 288)
+    deliveries = np.where(rng.uniform(size=len(seconds)) < 0.1, 1000.0, 0.0)
+    glucose = 100 + np.cumsum(rng.normal(size=len(seconds)))
+    return codec.Request(
+        timezone="UTC",
+        timeseries=[
+            codec.Timeseries.fromarrays("glucose", {}, seconds, glucose, "UTC"),
+            codec.Timeseries.fromarrays(
+                "insulin", {"delay": 5, "peak": 65, "duration": 205}, seconds, deliveries, "UTC"),
+            codec.Timeseries.fromarrays(
+                "carb", {"delay": 15, "duration": 120}, seconds, deliveries / 100, "UTC"),
+        ],
+    )
+
 
 class ModelTest(unittest.TestCase):
     def test_model(self):
         frame = make_test_frame()
         m = model.fit(frame)
 
+    def test_exact_gradients(self):
+        frame = make_test_frame()
+        frame.tuning_limit = 0.3
+        for smoothing in [0.0, 0.5]:
+            hyper_params = dict(
+                model.default_hyper_params, quantile_loss_smoothing=smoothing)
+            m = model.fit(frame, hyper_params)
+            self.assertTrue(np.isfinite(m.training_loss))
+            # With exact gradients, each iteration needs only a few
+            # evaluations (rather than one per parameter).
+            self.assertLess(
+                m.stats["loss_evaluations"], 5 * (m.stats["iterations"] + 1))
+
+    def test_linprog(self):
+        frame = make_test_frame()
+        hyper_params = dict(model.default_hyper_params, optimizer="linprog")
+        unbounded = model.fit(frame, hyper_params)
+        self.assertTrue(np.isfinite(unbounded.training_loss))
+        for key in ["iterations", "solver_iterations", "solve_time"]:
+            self.assertIn(key, unbounded.stats)
+
+        frame.tuning_limit = 0.3
+        bounded = model.fit(frame, hyper_params)
+        # Bounds are enforced exactly by the LP, rather than by a barrier;
+        # the test frame has no schedules, so initial parameters are the
+        # defaults of 140 (ISF) and 15 (carb ratio).
+        self.assertTrue(np.isfinite(bounded.training_loss))
+        isfs, carb_ratios = bounded.raw_insulin_sensitivities, bounded.raw_carb_ratios
+        self.assertTrue(np.all((isfs >= 140 * 0.7 - 1e-6) & (isfs <= 140 * 1.3 + 1e-6)))
+        self.assertTrue(
+            np.all((carb_ratios >= 15 * 0.7 - 1e-6) & (carb_ratios <= 15 * 1.3 + 1e-6)))
+
+
+class TuneParametersTest(unittest.TestCase):
+    def test_basal_only(self):
+        frame = make_test_frame()
+        frame.insulin_sensitivity_schedule = codec.Schedule([0, 720], [100.0, 120.0])
+        frame.carb_ratio_schedule = codec.Schedule([0], [12.0])
+        frame.tune_parameters = {"basal_rate_schedule"}
+        m = model.fit(frame)
+
+        self.assertEqual(m.tuned_parameters, ["basal_rate_schedule"])
+        self.assertEqual(m.stats["parameters"], 24)
+        self.assertEqual(m.params["insulin_sensitivity_schedule"], ([0, 720], [100.0, 120.0]))
+        self.assertEqual(m.params["carb_ratio_schedule"], ([0], [12.0]))
+        self.assertTrue(np.isfinite(m.training_loss))
+
+    def test_unknown(self):
+        frame = make_test_frame()
+        frame.tune_parameters = {"basal_rates"}
+        with self.assertRaises(Exception):
+            model.fit(frame)
+
+
+class AdamTest(unittest.TestCase):
+    def test_holdout(self):
+        frame = make_test_frame()
+        for holdout in [0.0, 0.25]:
+            hyper_params = dict(
+                model.default_hyper_params, optimizer="adam", holdout_fraction=holdout)
+            m = model.fit(frame, hyper_params)
+            self.assertTrue(np.isfinite(m.training_loss))
+            self.assertLessEqual(m.stats["iterations"], 10000)
+            self.assertEqual(m.stats["loss_evaluations"], m.stats["iterations"])
+
+
+class SquaredLossTest(unittest.TestCase):
+    def test_moments(self):
+        rng = np.random.RandomState(0)
+        n = 1000
+        hour = rng.randint(0, 24, size=n)
+        weights, deltas, carbs, insulin = rng.uniform(size=(4, n))
+        basals, isfs, carb_ratios = rng.uniform(0.5, 2.0, size=(3, 24))
+
+        preds = isfs[hour] * (carbs / carb_ratios[hour] - insulin + basals[hour])
+        expected = np.mean(np.square(weights * (deltas - preds)))
+        moments = model.hourly_moments(hour, weights, deltas, carbs, insulin)
+        self.assertAlmostEqual(
+            model.squared_loss(moments, n, basals, isfs, carb_ratios), expected)
+
+    def test_fit(self):
+        frame = make_test_frame()
+        m = model.fit(frame, dict(model.default_hyper_params, loss="squared"))
+        self.assertTrue(np.isfinite(m.training_loss))
+
+
+class SampleWeightsTest(unittest.TestCase):
+    def test_sample_weights(self):
+        request = make_days_request(3)
+        frame, _ = model.activity_frame(request)
+        for loss in ["quantile", "squared"]:
+            hyper_params = dict(model.default_hyper_params, loss=loss)
+            expected = model.fit(request, hyper_params)
+            ones = model.fit(
+                request, hyper_params, sample_weights=pd.Series(1.0, index=frame.index))
+            np.testing.assert_allclose(ones.raw_basals, expected.raw_basals)
+            self.assertAlmostEqual(ones.training_loss, expected.training_loss)
+
+            # Zero weights drop rows from the loss.
+            weights = pd.Series(1.0, index=frame.index)
+            weights[weights.index.day == weights.index[0].day] = 0.0
+            dropped = model.fit(request, hyper_params, sample_weights=weights)
+            self.assertNotAlmostEqual(dropped.training_loss, expected.training_loss)
+
+
+class PredictTest(unittest.TestCase):
+    def test_predict(self):
+        index = pd.date_range("2019-12-01", periods=3, freq="1H", tz="UTC")
+        frame = pd.DataFrame(
+            {"insulin": [1.0, 2.0, 0.0], "carb": [0.0, 10.0, 5.0]}, index=index)
+        basals, isfs, carb_ratios = np.arange(24.0), np.full(24, 2.0), np.full(24, 5.0)
+        np.testing.assert_allclose(
+            model.predict(frame, basals, isfs, carb_ratios),
+            [2 * (0 - 1 + 0), 2 * (2 - 2 + 1), 2 * (1 - 0 + 2)])
+
+    def test_pinball_loss(self):
+        np.testing.assert_allclose(
+            model.pinball_loss(np.array([-2.0, 0.0, 2.0]), 0.25), [1.5, 0.0, 0.5])
+
+
+class PrecisionTest(unittest.TestCase):
+    def fit(self, request, **hyper_params):
+        return [
+            model.fit(request, dict(model.default_hyper_params, precision=precision, **hyper_params))
+            for precision in ["float64", "float32"]
+        ]
+
+    def test_frame(self):
+        request = make_days_request(3)
+        hyper_params = dict(model.default_hyper_params, precision="float32")
+        frame, _ = model.activity_frame(request, dtype="float32")
+        self.assertTrue(all(dtype == np.float32 for dtype in frame.dtypes))
+        frame = model.make_frame(request, hyper_params)
+        self.assertTrue(all(dtype == np.float32 for dtype in frame.dtypes))
+
+        # Deltas are differences of glucose readings (~100 mg/dL), so
+        # their errors are relative to the readings.
+        expected = model.make_frame(request, model.default_hyper_params)
+        self.assertEqual(list(frame.columns), list(expected.columns))
+        pd.testing.assert_index_equal(frame.index, expected.index)
+        np.testing.assert_allclose(frame.values, expected.values, rtol=1e-4, atol=1e-4)
+
+    def test_schedules(self):
+        # Problems with a unique minimum should yield (nearly) the same
+        # schedules in either precision.
+        request = make_days_request(10)
+        for hyper_params in [{"loss": "squared"}, {"optimizer": "linprog"}]:
+            double, single = self.fit(request, **hyper_params)
+            for name in model.schedule_names:
+                np.testing.assert_allclose(
+                    single.params[name][1], double.params[name][1], rtol=1e-3, atol=1e-3)
+
+    def test_loss(self):
+        request = make_days_request(10)
+        double, single = self.fit(request)
+        self.assertAlmostEqual(
+            single.training_loss, double.training_loss, delta=0.05 * double.training_loss)
+
+
+class DesignMatrixTest(unittest.TestCase):
+    def reference(self, curve, index, nperiod=288):
+        curve = curve.astype("float64")
+        rolled = np.stack([np.roll(curve, i) for i in range(nperiod)])
+        X = np.zeros([nperiod, len(index)])
+        for i, ivs in enumerate(model.index_to_intervals(index, nperiod=nperiod)):
+            for beg, end in ivs:
+                X[:, i] += np.sum(rolled[:, beg:end], axis=1)
+        return X
+
+    def test_design_matrix(self):
+        curve = model.curve_coeffs("insulin", (5, 65, 205), horizon=288)
+        for index in [[0], [0, 72, 216], [30, 100, 250]]:
+            X = model.design_matrix(curve, np.array(index))
+            np.testing.assert_allclose(X, self.reference(curve, index), rtol=1e-12, atol=1e-12)
+            self.assertIs(X, model.design_matrix(curve, np.array(index)))
+            self.assertFalse(X.flags.writeable)
+
+    def test_attribute_parameters(self):
+        curve = model.curve_coeffs("insulin", (5, 65, 205), horizon=288).astype("float64")
+        rolled = np.stack([np.roll(np.flip(curve), i + 1) for i in range(288)])
+        for index, values in [([0], [1.0]), ([30, 100, 250], [1.0, 2.0, 3.0])]:
+            X = rolled.copy()
+            for i, ivs in enumerate(model.index_to_intervals(index)):
+                for beg, end in ivs:
+                    X[:, beg:end] *= values[i]
+            expected = np.mean(np.reshape(np.sum(X, axis=1), (24, 12)), axis=1)
+            np.testing.assert_allclose(
+                model.attribute_parameters(curve, index, values), expected, rtol=1e-12)
+
+    def test_resolution(self):
+        # Finer resolutions only cost linearly more.
+        curve = model.curve_coeffs("carb", (15, 180), horizon=1440, resolution=1)
+        x = model.attribute_parameters(curve, [0, 720], [10.0, 20.0], nperiod=1440)
+        self.assertEqual(x.shape, (24,))
+        self.assertTrue(np.all((x >= 10.0 - 1e-6) & (x <= 20.0 + 1e-6)))
+
 
 class IndexToIntervalsTest(unittest.TestCase):
     def test_index_to_intervals(self):
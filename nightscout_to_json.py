@@ -17,6 +17,8 @@ import pytz
 import numpy as np
 from pprint import pprint
 
+import codec
+
 
 TZ='Europe/Berlin' 
 
@@ -46,11 +48,12 @@ class Nightscout(object):
         raise Exception(response.status_code, response.text)
     return response.json()
 
-  def convert(self, profile, entries, treatments):
+  def convert(self, profile, entries, treatments, run_length=False):
     ps = profile[0]['store']['Default']
     tz = pytz.timezone(ps['timezone'])
     common = {
-            'version': 1,
+            # Version 2 permits run-length encoding.
+            'version': 2 if run_length else 1,
             'timezone': ps['timezone'],
             'minimum_time_interval': 3600,
             'maximum_schedule_item_count': 24,
@@ -98,10 +101,11 @@ class Nightscout(object):
         return lookup(hour, ret['insulin_sensitivity_schedule'])
 
     def encode(series):
-        o = 0
-        for i, v in enumerate(series):
-            series[i] -= o
-            o = v
+        encoded = np.diff(np.array(series), prepend=0)
+        if run_length:
+            series[:] = codec.rle(encoded)
+        else:
+            series[:] = encoded.tolist()
 
     buckets = {
        'start_ts': None,
@@ -343,6 +347,9 @@ if __name__ == '__main__':
   parser.add_argument("--url", type=str, help="nightscout url")
   parser.add_argument("--secret", type=str, help="nightscout secret")
   parser.add_argument("--days", type=int, help="days to retrieve since yesterday")
+  parser.add_argument("--format", type=str, choices=["json", "columnar"], default="json",
+                      help="request encoding")
+  parser.add_argument("--rle", action="store_true", help="run-length encode timelines")
   args = parser.parse_args()
 
   days = int(args.days or 1)
@@ -375,9 +382,13 @@ if __name__ == '__main__':
           {'find[dateString][$gte]': startdate, 'find[dateString][$lte]:': enddate, 'count': '10000'})
   if not j:
     open(cache_fn, 'w').write(json.dumps({'p': profile, 'e': entries, 't': treatments}, indent=4, sort_keys=True))
-  ret, new = dl.convert(profile, entries, treatments)
-  output_fn = 'ret_%s_%s.json' % (startdate, enddate)
-  open(output_fn, 'w').write(json.dumps(ret, indent=4, sort_keys=True))
+  ret, new = dl.convert(profile, entries, treatments, run_length=args.rle)
+  if args.format == 'columnar':
+    output_fn = 'ret_%s_%s.bin' % (startdate, enddate)
+    open(output_fn, 'wb').write(codec.dumps_columnar(ret))
+  else:
+    output_fn = 'ret_%s_%s.json' % (startdate, enddate)
+    open(output_fn, 'w').write(json.dumps(ret, indent=4, sort_keys=True))
 
   new_fn = 'new_%s_%s.json' % (startdate, enddate)
   open(new_fn, 'w').write(json.dumps(new, indent=4, sort_keys=True))
@@ -0,0 +1,224 @@
+"""store implements an append-only, per-user store of timelines,
+resampled onto the model's 5-minute grid.
+
+Each user's store is a directory holding a metadata file (meta.json)
+and one file of float64 values per column: glucose, and the total
+deliveries for each distinct insulin or carb curve. All columns
+share a grid that starts at a fixed period and grows as data are
+appended. Columns are read as memory-mapped arrays, so that fits
+neither decode nor resample the user's history."""
+
+import contextlib
+import fcntl
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+import codec
+import model
+
+
+class StoreError(Exception):
+    pass
+
+
+_user_id = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+class Store:
+    """Store is a directory of per-user stores, rooted at root."""
+
+    def __init__(self, root, period=model.PeriodSeconds):
+        self.root = root
+        self.period = period
+
+    def path(self, user_id, *names):
+        if _user_id.fullmatch(user_id) is None or user_id.startswith("."):
+            raise StoreError(f"invalid user id {user_id!r}")
+        return os.path.join(self.root, user_id, *names)
+
+    @contextlib.contextmanager
+    def locked(self, user_id):
+        """Hold the user's store lock, creating the store if needed."""
+        os.makedirs(self.path(user_id), exist_ok=True)
+        with open(self.path(user_id, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def meta(self, user_id):
+        """Return the user's store metadata, or None if the store is
+        empty. Metadata include the timezone, the first period (in Unix
+        seconds) and length of the grid; the columns: for each, its
+        timeline type and curve parameters; and the sources: for each
+        type and parameters of the appended timelines, the time (in
+        Unix seconds) of the last entry appended, before it was
+        expanded by its duration."""
+        try:
+            with open(self.path(user_id, "meta.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, user_id, meta):
+        tmp = self.path(user_id, "meta.json.tmp")
+        with open(tmp, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp, self.path(user_id, "meta.json"))
+
+    def column(self, user_id, i, length, mode="r"):
+        if length == 0:
+            return np.zeros(0)
+        return np.memmap(
+            self.path(user_id, f"{i}.f64"), dtype=np.float64, mode=mode, shape=(length,))
+
+    def append(self, user_id, request):
+        """Append the request's timelines to the user's store.
+        Deliveries are added to the grid; glucose readings are kept
+        only for periods without an earlier reading. Timelines may not
+        include data from before the start of the store. Entries at or
+        before the last one appended from a timeline of the same type
+        and parameters are dropped, so that overlapping (or repeated)
+        uploads do not count deliveries twice."""
+        timeseries = [col for col in request.timeseries if len(col) > 0]
+        if not timeseries:
+            return
+        with self.locked(user_id):
+            meta = self.meta(user_id)
+            if meta is None:
+                first = min(np.min(col.seconds) for col in timeseries)
+                meta = {"start": int(first // self.period * self.period),
+                        "length": 0, "columns": [], "sources": []}
+            meta["timezone"] = str(request.timezone)
+
+            first = min(np.min(col.seconds) for col in timeseries)
+            if first < meta["start"]:
+                raise StoreError(
+                    f"data at {first} precede the start of the store at {meta['start']}")
+            # Drop the entries that were already appended. Entries are
+            # compared by the times they were recorded at, rather than
+            # the periods they were expanded into, since a long entry
+            # (e.g., a basal) may overlap later ones.
+            lasts = [self._source(meta, col)["last"] for col in timeseries]
+            for col in timeseries:
+                source = self._source(meta, col)
+                source["last"] = max(source["last"], int(np.max(col.sources)))
+            timeseries = [col.select(col.sources > last) for col, last in zip(timeseries, lasts)]
+            timeseries = [col for col in timeseries if len(col) > 0]
+            if not timeseries:
+                return
+
+            last = max(np.max(col.seconds) for col in timeseries)
+            length = max(meta["length"], int((last - meta["start"]) // self.period) + 1)
+
+            # Grow every column to the new length.
+            for i in range(len(meta["columns"])):
+                self._grow(user_id, i, meta, length)
+            for col in timeseries:
+                if self._column(meta, col) is None:
+                    meta["columns"].append(self._key(col))
+                    self._grow(user_id, len(meta["columns"]) - 1, meta, length)
+            meta["length"] = length
+
+            for col in timeseries:
+                i = self._column(meta, col)
+                grid = self.column(user_id, i, length, mode="r+")
+                buckets = (col.seconds - meta["start"]) // self.period
+                values = np.asarray(col.values, dtype=np.float64)
+                if col.ctype == "glucose":
+                    order = np.argsort(col.seconds, kind="stable")
+                    new = model.first_by_bucket(buckets[order], values[order], length)
+                    grid[:] = np.where(np.isnan(grid), new, grid)
+                else:
+                    grid += np.bincount(
+                        buckets, weights=np.nan_to_num(values), minlength=length)
+                grid.flush()
+                del grid
+
+            self._write_meta(user_id, meta)
+
+    def _column(self, meta, col):
+        """The index of the timeline's column, or None if it has none."""
+        key = self._key(col)
+        for i, column in enumerate(meta["columns"]):
+            if column["type"] == key["type"] and column["parameters"] == key["parameters"]:
+                return i
+        return None
+
+    def _source(self, meta, col):
+        """The source metadata of the timeline's type and parameters,
+        which are added if there are none."""
+        for source in meta["sources"]:
+            if source["type"] == col.ctype and source["parameters"] == col.meta:
+                return source
+        source = {"type": col.ctype, "parameters": dict(col.meta), "last": -math.inf}
+        meta["sources"].append(source)
+        return source
+
+    def _key(self, col):
+        if col.ctype == "glucose":
+            return {"type": "glucose", "parameters": {}}
+        kind, params = model.curve_params(col)
+        if kind == "carb":
+            names = ["delay", "duration"]
+        else:
+            names = ["delay", "peak", "duration"]
+        return {"type": kind, "parameters": dict(zip(names, map(float, params)))}
+
+    def _grow(self, user_id, i, meta, length):
+        path = self.path(user_id, f"{i}.f64")
+        current = os.path.getsize(path) // 8 if os.path.exists(path) else 0
+        if current >= length:
+            return
+        fill = math.nan if meta["columns"][i]["type"] == "glucose" else 0.0
+        with open(path, "ab") as file:
+            file.write(np.full(length - current, fill).tobytes())
+
+    def request(self, user_id, start=None, end=None, warmup=None):
+        """Return the user's timelines, resampled onto the grid, for
+        periods in [start, end] (Unix seconds; unbounded if None) as
+        well as warmup seconds before start (by default, the
+        model.frame_warmup of the default hyper parameters). Values
+        are memory-mapped, and read-only."""
+        if warmup is None:
+            warmup = model.frame_warmup()
+        meta = self.meta(user_id)
+        if meta is None:
+            raise StoreError(f"no data for user {user_id}")
+        seconds = meta["start"] + self.period * np.arange(meta["length"])
+        lo, hi = 0, meta["length"]
+        if start is not None:
+            lo = int(np.searchsorted(seconds, start - warmup))
+        if end is not None:
+            hi = int(np.searchsorted(seconds, end, side="right"))
+        if lo >= hi:
+            raise StoreError(f"no data for user {user_id} in [{start}, {end}]")
+
+        timeseries = [
+            codec.Timeseries.fromarrays(
+                key["type"], dict(key["parameters"]), seconds[lo:hi],
+                self.column(user_id, i, meta["length"])[lo:hi], meta["timezone"])
+            for i, key in enumerate(meta["columns"])
+        ]
+        return codec.Request(timezone=meta["timezone"], timeseries=timeseries)
+
+    def activity(self, user_id, start=None, end=None, dtype="float64", warmup=None,
+                 frame_limit=None):
+        """The activity frame (see model.activity_frame) of the user's
+        data in [start, end] (with warmup seconds before start; see
+        request), further restricted to the window selected by
+        frame_limit, in the given dtype. Since the stored data are
+        already resampled, this only computes activity."""
+        request = self.request(user_id, start, end, warmup)
+        request, limit_start = model.limit_frame(request, frame_limit, warmup)
+        if not request.timeseries:
+            raise StoreError(f"no data for user {user_id} within frame_limit {frame_limit}")
+        if limit_start is not None:
+            start = limit_start if start is None else max(start, limit_start)
+        frame = model.make_pandas_frame(request, dtype)
+        return frame, start
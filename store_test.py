@@ -0,0 +1,120 @@
+import math
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import codec
+import model
+import model_test
+import store
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = store.Store(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def split(self, request, seconds):
+        """Split the request's timelines into those before and after seconds."""
+        def window(start, end):
+            return codec.Request(
+                timezone=request.timezone,
+                timeseries=[col.window(start, end) for col in request.timeseries])
+        return window(0, seconds - 1), window(seconds, math.inf)
+
+    def test_append(self):
+        request = model_test.make_days_request(2)
+        head, tail = self.split(request, request.timeseries[0].seconds[300] + 60)
+        self.store.append("user", head)
+        self.store.append("user", tail)
+
+        actual, start = self.store.activity("user")
+        expected, _ = model.activity_frame(request)
+        self.assertIsNone(start)
+        pd.testing.assert_frame_equal(actual, expected)
+
+        meta = self.store.meta("user")
+        self.assertEqual(meta["length"], 2 * 288)
+        self.assertEqual([key["type"] for key in meta["columns"]], ["glucose", "insulin", "carb"])
+
+    def test_reingest(self):
+        request = model_test.make_days_request(2)
+        head, _ = self.split(request, request.timeseries[0].seconds[400])
+        self.store.append("user", head)
+        self.store.append("user", request)
+        expected, _ = self.store.activity("user")
+        meta = self.store.meta("user")
+
+        # Uploading the same data again changes nothing.
+        self.store.append("user", request)
+        self.store.append("user", head)
+        actual, _ = self.store.activity("user")
+        pd.testing.assert_frame_equal(actual, expected)
+        self.assertEqual(self.store.meta("user"), meta)
+
+        reference, _ = model.activity_frame(request)
+        pd.testing.assert_frame_equal(actual, reference)
+
+    def test_overlapping_entries(self):
+        # A basal and a later bolus share a curve, and so a column; the
+        # basal's expansion extends past the bolus.
+        start = 1575158400
+        parameters = {"delay": 5, "peak": 65, "duration": 205}
+
+        def upload(ctype, index, values, durations):
+            return codec.Request.fromdict({
+                "version": 1,
+                "timezone": "UTC",
+                "timelines": [{"type": ctype, "parameters": parameters, "index": index,
+                               "values": values, "durations": durations}],
+            })
+
+        basal = upload("basal", [start], [500], [7200])
+        bolus = upload("bolus", [start + 1800], [3000], [0])
+        for request in [basal, bolus, basal, bolus]:
+            self.store.append("user", request)
+
+        meta = self.store.meta("user")
+        self.assertEqual(len(meta["columns"]), 1)
+        self.assertAlmostEqual(np.sum(self.store.column("user", 0, meta["length"])), 3500)
+
+    def test_range(self):
+        request = model_test.make_days_request(2)
+        self.store.append("user", request)
+        seconds = request.timeseries[0].seconds
+        stored = self.store.request("user", start=seconds[288], end=seconds[400])
+        for col in stored.timeseries:
+            self.assertEqual(col.seconds[0], seconds[288] - model.frame_warmup())
+            self.assertEqual(col.seconds[-1], seconds[400])
+
+        # frame_limit further restricts the range, relative to its end.
+        frame, start = self.store.activity("user", end=seconds[400], frame_limit=0.25)
+        self.assertEqual(start, seconds[400] - 6 * 60 * 60)
+        self.assertEqual(codec.epoch_seconds(frame.index)[0], start - model.frame_warmup())
+        self.assertEqual(codec.epoch_seconds(frame.index)[-1], seconds[400])
+        frame, start = self.store.activity(
+            "user", start=seconds[350], frame_limit=[seconds[300], seconds[400]])
+        self.assertEqual(start, seconds[350])
+        self.assertEqual(codec.epoch_seconds(frame.index)[-1], seconds[400])
+        with self.assertRaises(store.StoreError):
+            self.store.activity("user", frame_limit=[0, 100])
+
+    def test_errors(self):
+        request = model_test.make_days_request(1)
+        head, tail = self.split(request, request.timeseries[0].seconds[100])
+        self.store.append("user", tail)
+        with self.assertRaises(store.StoreError):
+            self.store.append("user", head)
+        with self.assertRaises(store.StoreError):
+            self.store.append("../user", tail)
+        with self.assertRaises(store.StoreError):
+            self.store.activity("nobody")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+"""sweep fits a model for each of a set of hyper parameter
+configurations, and reports them ranked by training loss.
+
+Insulin and carb activity, the expensive part of building a training
+frame, depends only on the request and the frame_limit and precision
+hyper parameters. It is computed once for each distinct pair in the
+sweep and placed in shared memory, from which a pool of worker
+processes fit the configurations.
+
+For example:
+
+    $ python sweep.py request.json --param rolling_window=1,4,8 \\
+        --param maxdelta=5,10 --samples 4
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+import random
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import codec
+import model
+
+
+def parse_param(spec):
+    """Parse a "key=value,value,..." sweep specification. Values are
+    parsed by the type of the key's default value."""
+    key, _, values = spec.partition("=")
+    if key not in model.default_hyper_params:
+        raise argparse.ArgumentTypeError(f"unknown hyper parameter {key}")
+    kind = type(model.default_hyper_params[key])
+    return key, [kind(value) for value in values.split(",")]
+
+
+def configurations(params, samples=None, seed=0):
+    """The grid of hyper parameter configurations given by params (a
+    list of (key, values) pairs), or samples of them drawn at random."""
+    keys = [key for key, _ in params]
+    grid = [dict(zip(keys, values))
+            for values in itertools.product(*(values for _, values in params))]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+class SharedFrame:
+    """SharedFrame places the columns of an activity frame (see
+    model.activity_frame) in a shared memory block, from which other
+    processes can reconstruct the frame without copying it."""
+
+    columns = ["insulin", "carb", "glucose"]
+
+    def __init__(self, frame, start):
+        self.start = start
+        self.timezone = frame.index.tz
+        self.length = len(frame)
+        self.dtype = np.result_type(*frame[self.columns].dtypes)
+        seconds = codec.epoch_seconds(frame.index)
+        size = (8 + self.dtype.itemsize * len(self.columns)) * self.length
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self.shm.name
+        self.seconds, self.values = self.arrays(self.shm)
+        self.seconds[:] = seconds
+        for i, column in enumerate(self.columns):
+            self.values[i] = frame[column].values
+
+    def arrays(self, shm):
+        seconds = np.ndarray(self.length, dtype=np.int64, buffer=shm.buf)
+        values = np.ndarray(
+            (len(self.columns), self.length), dtype=self.dtype, buffer=shm.buf,
+            offset=8 * self.length)
+        return seconds, values
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in ["shm", "seconds", "values"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        self.seconds, self.values = self.arrays(self.shm)
+
+    def activity(self):
+        """Reconstruct the activity frame, whose columns are views of
+        the shared memory block."""
+        index = pd.to_datetime(self.seconds, unit="s", utc=True).tz_convert(self.timezone)
+        frame = pd.DataFrame(
+            dict(zip(self.columns, self.values)), index=index, copy=False)
+        return frame, self.start
+
+    def close(self, unlink=False):
+        self.seconds = self.values = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def frame_key(hyper_params):
+    """The key of the shared frame used by a configuration."""
+    return repr(model.activity_key(hyper_params))
+
+
+@contextlib.contextmanager
+def shared_frames(request, configs):
+    """Compute the activity frame used by each of configs (see
+    frame_key), and place it in shared memory for the duration of the
+    context, yielding a dict of SharedFrames by frame key."""
+    frames = {}
+    try:
+        for config in configs:
+            if frame_key(config) not in frames:
+                frames[frame_key(config)] = SharedFrame(*model.activity_frame(
+                    request, config.get("frame_limit"), config.get("precision"),
+                    model.frame_warmup(config)))
+        yield frames
+    finally:
+        for frame in frames.values():
+            frame.close(unlink=True)
+
+
+# The request and shared frames of a worker process.
+_request, _frames = None, None
+
+
+def init_worker(request, frames):
+    global _request, _frames
+    # Keep the model's diagnostic output out of the results table.
+    sys.stdout = sys.stderr
+    _request = request
+    _frames = {key: frame.activity() for key, frame in frames.items()}
+
+
+def worker_frame(hyper_params):
+    """The request and the shared activity frame used by a
+    configuration, in a worker process (see init_worker)."""
+    return _request, _frames[frame_key(hyper_params)]
+
+
+def fit_configuration(hyper_params):
+    start = time.perf_counter()
+    request, activity = worker_frame(hyper_params)
+    try:
+        fitted = model.fit(request, hyper_params, activity=activity)
+        training_loss = fitted.training_loss
+    except Exception:
+        logging.exception(f"fitting {hyper_params} failed")
+        training_loss = float("nan")
+    return hyper_params, training_loss, time.perf_counter() - start
+
+
+def sweep(request, configs, processes=None):
+    """Fit the request with each configuration (a dict of hyper
+    parameters, overriding model.default_hyper_params), returning a
+    list of (configuration, training loss, wall time) ordered by
+    training loss."""
+    configs = [
+        {**model.default_hyper_params, **request.hyper_params, **config}
+        for config in configs
+    ]
+    # Workers don't need the (large) timeseries themselves; the
+    # request's hyper parameters are already merged into configs.
+    bare = dataclasses.replace(request, timeseries=[], hyper_params={})
+    with shared_frames(request, configs) as frames, multiprocessing.Pool(
+            processes, initializer=init_worker, initargs=(bare, frames)) as pool:
+        results = pool.map(fit_configuration, configs, chunksize=1)
+
+    return sorted(results, key=lambda result: (np.isnan(result[1]), result[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", type=str, nargs="?", help="request to read")
+    parser.add_argument(
+        "--param", type=parse_param, action="append", default=[],
+        help="hyper parameter values to sweep, as key=value,value,...")
+    parser.add_argument("--samples", type=int, help="sample this many configurations")
+    parser.add_argument("--seed", type=int, default=0, help="seed for sampling")
+    parser.add_argument("--processes", type=int, help="number of worker processes")
+    parser.add_argument("--output", type=str, help="write the table to file")
+    args = parser.parse_args()
+
+    if args.file is None:
+        body = sys.stdin.buffer.read()
+    else:
+        with open(args.file, "rb") as input:
+            body = input.read()
+    request = codec.decode_request(body, model.frame_warmup)
+
+    configs = configurations(args.param, samples=args.samples, seed=args.seed)
+    with contextlib.redirect_stdout(sys.stderr):
+        results = sweep(request, configs, processes=args.processes)
+
+    keys = [key for key, _ in args.param]
+    lines = ["\t".join(["rank", "training_loss", "time"] + keys)]
+    for rank, (config, training_loss, elapsed) in enumerate(results):
+        lines.append("\t".join(
+            [str(rank + 1), f"{training_loss:.6g}", f"{elapsed:.3f}"]
+            + [str(config[key]) for key in keys]))
+    output = "\n".join(lines) + "\n"
+    if args.output is None:
+        sys.stdout.write(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
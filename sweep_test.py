@@ -0,0 +1,65 @@
+import pickle
+import unittest
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import model
+import model_test
+import sweep
+
+
+class SweepTest(unittest.TestCase):
+    def test_configurations(self):
+        params = [("rolling_window", [1, 8]), ("maxdelta", [5.0, 10.0, 20.0])]
+        grid = sweep.configurations(params)
+        self.assertEqual(len(grid), 6)
+        self.assertIn({"rolling_window": 8, "maxdelta": 10.0}, grid)
+
+        samples = sweep.configurations(params, samples=3)
+        self.assertEqual(len(samples), 3)
+        for config in samples:
+            self.assertIn(config, grid)
+
+    def test_shared_frame(self):
+        for dtype in ["float64", "float32"]:
+            frame, start = model.activity_frame(model_test.make_test_frame(), dtype=dtype)
+            shared = sweep.SharedFrame(frame, start)
+            try:
+                # Pickling (as when passed to a worker process) attaches to
+                # the same shared memory block.
+                attached = pickle.loads(pickle.dumps(shared))
+                actual, actual_start = attached.activity()
+                self.assertEqual(actual_start, start)
+                pd.testing.assert_frame_equal(actual, frame[sweep.SharedFrame.columns])
+                attached.close()
+            finally:
+                shared.close(unlink=True)
+
+    def test_shared_frames(self):
+        request = model_test.make_test_frame()
+        configs = [dict(model.default_hyper_params, rolling_window=window) for window in [1, 8]]
+        with sweep.shared_frames(request, configs) as frames:
+            # Configurations without a frame limit share a frame.
+            self.assertEqual(list(frames), [sweep.frame_key(configs[0])])
+            name = frames[sweep.frame_key(configs[0])].shm.name
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    def test_sweep(self):
+        request = model_test.make_test_frame()
+        configs = [{"rolling_window": 8}, {"rolling_window": 1}]
+        results = sweep.sweep(request, configs, processes=1)
+
+        self.assertEqual(
+            sorted(config["rolling_window"] for config, _, _ in results), [1, 8])
+        losses = [training_loss for _, training_loss, _ in results]
+        self.assertEqual(losses, sorted(losses))
+        for config, training_loss, _ in results:
+            expected = model.fit(request, config).training_loss
+            self.assertAlmostEqual(training_loss, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,29 +1,55 @@
 import logging
 
-from autograd import grad
-from autograd.misc.optimizers import adam
-
-
-def minimize(loss, init_params, step_size=0.05, num_iters=10000, optimizer=adam):
-    """TODO: we should be doing early stopping on a hold-out set"""
-    min_loss, min_params, min_iter = None, None, None
-
-    def at_iter(params, iter, gradient):
-        nonlocal min_loss, min_params, min_iter
-        l = loss(params, iter)
-        if min_loss is not None and l >= min_loss:
-            return
-        min_loss = l
-        min_params = params
-        min_iter = iter
-
-    optimizer(
-        grad(loss),
-        init_params,
-        step_size=step_size,
-        num_iters=num_iters,
-        callback=at_iter,
-    )
-    logging.info(f"minimum loss {min_loss} at iter {min_iter} of {num_iters}")
-
-    return min_params, min_loss
+from autograd import value_and_grad
+import autograd.numpy as np
+
+
+def minimize(loss, init_params, step_size=0.05, num_iters=10000,
+             tol=1e-6, gtol=1e-6, patience=100, holdout_loss=None,
+             b1=0.9, b2=0.999, eps=1e-8):
+    """Minimize loss(params, iter) with Adam, starting from init_params.
+
+    Each step evaluates the loss and its gradient once. Optimization
+    stops after num_iters steps; when the gradient's largest component
+    is at most gtol; or when the monitored loss has not improved by a
+    relative tol in patience steps. The monitored loss is the training
+    loss, or, if provided, holdout_loss(params) -- e.g., the loss on a
+    held-out slice of the data -- so that optimization stops early once
+    the model starts to overfit.
+
+    Returns the parameters with the smallest monitored loss, their
+    training loss, and the number of steps taken."""
+    loss_and_grad = value_and_grad(loss)
+    params = np.array(init_params, dtype="float64")
+    m = np.zeros_like(params)
+    v = np.zeros_like(params)
+
+    min_loss, min_params, min_iter, min_monitored = None, None, None, None
+    # The monitored loss when it last improved by a relative tol.
+    last_improved, last_improved_iter = None, None
+    iters = 0
+    for i in range(num_iters):
+        iters = i + 1
+        value, gradient = loss_and_grad(params, i)
+        monitored = value if holdout_loss is None else holdout_loss(params)
+
+        if min_monitored is None or monitored < min_monitored:
+            min_loss, min_params, min_iter, min_monitored = value, params, i, monitored
+        if last_improved is None or monitored < last_improved - tol * abs(last_improved):
+            last_improved, last_improved_iter = monitored, i
+        elif i - last_improved_iter >= patience:
+            break
+        if np.max(np.abs(gradient)) <= gtol:
+            break
+
+        m = (1 - b1) * gradient + b1 * m
+        v = (1 - b2) * np.square(gradient) + b2 * v
+        mhat = m / (1 - b1 ** (i + 1))
+        vhat = v / (1 - b2 ** (i + 1))
+        params = params - step_size * mhat / (np.sqrt(vhat) + eps)
+
+    logging.info(
+        f"minimum loss {min_loss} at iter {min_iter}; "
+        f"used {iters} of {num_iters} iterations")
+
+    return min_params, min_loss, iters
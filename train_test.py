@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+import train
+
+
+class MinimizeTest(unittest.TestCase):
+    def test_converges(self):
+        target = np.array([1.0, -2.0, 3.0])
+        evaluations = 0
+
+        def loss(params, iter):
+            nonlocal evaluations
+            evaluations += 1
+            return np.sum(np.square(params - target))
+
+        params, value, iters = train.minimize(loss, np.zeros(3))
+        np.testing.assert_allclose(params, target, atol=1e-2)
+        self.assertLess(value, 1e-4)
+        self.assertLess(iters, 10000)
+        # One evaluation per step.
+        self.assertEqual(evaluations, iters)
+
+    def test_holdout(self):
+        # The training loss pulls params to 1, but the hold-out loss is
+        # minimized at 0.5; optimization should stop (and return params)
+        # near the hold-out minimum.
+        def loss(params, iter):
+            return np.sum(np.square(params - 1.0))
+
+        def holdout_loss(params):
+            return float(np.sum(np.square(params - 0.5)))
+
+        params, value, iters = train.minimize(
+            loss, np.zeros(1), step_size=0.01, patience=10, holdout_loss=holdout_loss)
+        np.testing.assert_allclose(params, [0.5], atol=0.02)
+        self.assertLess(iters, 1000)
+
+    def test_small_improvements(self):
+        # The monitored loss keeps improving, but by less than tol:
+        # optimization stops after patience steps, returning the
+        # parameters with the smallest monitored loss nonetheless.
+        evaluated = []
+
+        def loss(params, iter):
+            return np.sum(np.square(params - 1.0))
+
+        def holdout_loss(params):
+            evaluated.append(params)
+            return 1.0 - 1e-9 * len(evaluated)
+
+        params, value, iters = train.minimize(
+            loss, np.zeros(1), tol=1e-6, patience=10, holdout_loss=holdout_loss)
+        self.assertEqual(iters, 11)
+        np.testing.assert_array_equal(params, evaluated[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()